@@ -0,0 +1,445 @@
+# Banco de pruebas de carga para la API
+#
+# Levanta la aplicación con uvicorn contra una base MySQL local (por ejemplo un
+# contenedor de docker), la llena con datos sintéticos y ejecuta escenarios
+# (hora pico en portería, tablero de administración, listados). Al final
+# escribe en JSON el rendimiento y la latencia p50/p95/p99 por ruta.
+#
+# Las tablas se vacían antes de sembrar, por eso la base por defecto es
+# cci_bench y el banco se niega a usar la base "cci".
+#
+#   docker run -d --name cci-bench -p 3310:3306 -e MYSQL_ROOT_PASSWORD=cci mysql:8
+#   python benchmark.py --bd-puerto 3310 --escala 5000 --salida resultado.json
+#   python benchmark.py --bd-puerto 3310 --comparar resultado.json   # falla si hay regresión
+#   python benchmark.py --bd-embebida --escala 500                    # sin MySQL (ver abajo)
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import httpx
+import mysql.connector
+
+
+ESQUEMA = [
+    """CREATE TABLE IF NOT EXISTS roles (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        nombre VARCHAR(100), apellido VARCHAR(100), usuario VARCHAR(100),
+        contrasena VARCHAR(100), documento VARCHAR(20), rol VARCHAR(50)
+    )""",
+    """CREATE TABLE IF NOT EXISTS beneficiarios (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        nombre VARCHAR(100), apellido VARCHAR(100), documento BIGINT,
+        telefono BIGINT, usuario VARCHAR(100), contrasena VARCHAR(100),
+        INDEX (documento), INDEX (usuario)
+    )""",
+    """CREATE TABLE IF NOT EXISTS vehiculos (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        placa VARCHAR(20), tipovehiculo VARCHAR(50), documento BIGINT,
+        INDEX (documento)
+    )""",
+    """CREATE TABLE IF NOT EXISTS registros (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        placa VARCHAR(20), documento BIGINT, estado VARCHAR(20),
+        fecha_ingreso DATETIME, fecha_salida DATETIME NULL,
+        puesto INT, valor_parqueo DECIMAL(10, 2)
+    )""",
+    """CREATE TABLE IF NOT EXISTS contactos (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        nombre VARCHAR(100), telefono BIGINT, email VARCHAR(100), mensaje TEXT
+    )""",
+]
+
+TIPOS_VEHICULO = ["carro", "moto", "bicicleta"]
+
+
+# Cada escenario: concurrencia (usuarios simultáneos) y rutas con su peso.
+# Las rutas con {usuario} o {id} se completan con datos sembrados.
+ESCENARIOS = {
+    "hora_pico": {
+        "concurrencia": 50,
+        "rutas": [(4, "/obtener_qr/{usuario}"), (1, "/puestos/")],
+    },
+    "tablero": {
+        "concurrencia": 5,
+        "rutas": [(1, "/ingreso_dia"), (1, "/salida_dia"), (1, "/total_bene"), (1, "/grafico"), (1, "/puestos/")],
+    },
+    "listados": {
+        "concurrencia": 4,
+        "rutas": [(2, "/mostrarbeneficiarios"), (1, "/mostraregingresosalida"), (1, "/mostrarempleados")],
+    },
+}
+
+
+def config_bd(args) -> dict:
+    return {
+        "host": args.bd_host,
+        "port": args.bd_puerto,
+        "user": args.bd_usuario,
+        "password": args.bd_contrasena,
+        "database": args.bd_nombre,
+    }
+
+
+def sembrar(args):
+    """Crea la base y las tablas y las llena con `escala` beneficiarios y sus datos asociados."""
+    rnd = random.Random(args.semilla)
+    if not args.bd_embebida:
+        servidor = mysql.connector.connect(**{**config_bd(args), "database": None})
+        servidor.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{args.bd_nombre}`")
+        servidor.close()
+    mydb = mysql.connector.connect(**config_bd(args))
+    cursor = mydb.cursor()
+    for sentencia in ESQUEMA:
+        cursor.execute(sentencia)
+    for tabla in ("roles", "beneficiarios", "vehiculos", "registros", "contactos"):
+        cursor.execute(f"TRUNCATE TABLE {tabla}")
+
+    cursor.executemany(
+        "INSERT INTO roles (nombre, apellido, usuario, contrasena, documento, rol) VALUES (%s, %s, %s, %s, %s, %s)",
+        [(f"Empleado{i}", f"Apellido{i}", f"empleado{i}", "clave", str(90000000 + i), "administrador" if i < 3 else "vigilante")
+         for i in range(max(10, args.escala // 100))]
+    )
+
+    beneficiarios, vehiculos = [], []
+    for i in range(args.escala):
+        documento = 10000000 + i
+        beneficiarios.append((f"Nombre{i}", f"Apellido{i}", documento, 3000000000 + i, f"usuario{i}", "clave"))
+        for j in range(rnd.choice((1, 1, 1, 2))):
+            vehiculos.append((f"P{i:06d}{j}", rnd.choice(TIPOS_VEHICULO), documento))
+    cursor.executemany(
+        "INSERT INTO beneficiarios (nombre, apellido, documento, telefono, usuario, contrasena) VALUES (%s, %s, %s, %s, %s, %s)",
+        beneficiarios
+    )
+    cursor.executemany("INSERT INTO vehiculos (placa, tipovehiculo, documento) VALUES (%s, %s, %s)", vehiculos)
+
+    ahora = datetime.now()
+    registros = []
+    for _ in range(args.escala * args.registros_por_beneficiario):
+        placa, _, documento = rnd.choice(vehiculos)
+        ingreso = ahora - timedelta(minutes=rnd.randint(0, 60 * 24 * 14))
+        salida = ingreso + timedelta(minutes=rnd.randint(10, 600))
+        if salida > ahora:
+            registros.append((placa, documento, "ingreso", ingreso, None, rnd.randint(1, 20), None))
+        else:
+            registros.append((placa, documento, "salida", ingreso, salida, rnd.randint(1, 20), rnd.randint(2, 30) * 1000))
+    for inicio in range(0, len(registros), 5000):
+        cursor.executemany(
+            "INSERT INTO registros (placa, documento, estado, fecha_ingreso, fecha_salida, puesto, valor_parqueo) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+            registros[inicio:inicio + 5000]
+        )
+
+    mydb.commit()
+    cursor.close()
+    mydb.close()
+    return {"beneficiarios": len(beneficiarios), "vehiculos": len(vehiculos), "registros": len(registros)}
+
+
+# ---------------------------------------------------------------------------
+# Base embebida (--bd-embebida): un servidor que habla el protocolo de MySQL
+# (mysql-mimic) y guarda los datos en SQLite, traduciendo cada sentencia con
+# sqlglot. Sirve para correr el banco sin instalar MySQL; los tiempos no son
+# comparables con los de MySQL real y no hay transacciones. Requiere:
+#   pip install mysql-mimic sqlglot
+# ---------------------------------------------------------------------------
+def dia_semana_mysql(fecha):
+    # DAYOFWEEK de MySQL: domingo = 1 ... sábado = 7
+    if fecha is None:
+        return None
+    return datetime.fromisoformat(str(fecha)).isoweekday() % 7 + 1
+
+
+def traducir_sqlite(expresion):
+    """Traduce una sentencia de MySQL a una o más sentencias de SQLite."""
+    from sqlglot import exp
+
+    if isinstance(expresion, exp.TruncateTable):
+        return [f"DELETE FROM {tabla.sql()}" for tabla in expresion.expressions]
+    if isinstance(expresion, exp.Create) and isinstance(expresion.this, exp.Schema):
+        # SQLite no acepta INDEX (...) dentro de CREATE TABLE: se crean aparte
+        tabla = expresion.this.this.sql()
+        indices = [c for c in expresion.this.expressions if isinstance(c, exp.IndexColumnConstraint)]
+        for indice in indices:
+            indice.pop()
+        sentencias = [expresion.sql(dialect="sqlite")]
+        for indice in indices:
+            columnas = ", ".join(c.sql() for c in indice.expressions)
+            nombre = "_".join([tabla] + [c.sql() for c in indice.expressions])
+            sentencias.append(f"CREATE INDEX IF NOT EXISTS idx_{nombre} ON {tabla} ({columnas})")
+        return sentencias
+    return [expresion.sql(dialect="sqlite")]
+
+
+def servir_bd_embebida(puerto: int, ruta: str, usuario: str, contrasena: str, listo):
+    import sqlite3
+    from mysql_mimic import IdentityProvider, MysqlServer, NativePasswordAuthPlugin, Session, User
+
+    class UsuarioBanco(IdentityProvider):
+        async def get_user(self, username):
+            if username != usuario:
+                return None
+            return User(
+                name=usuario,
+                auth_string=NativePasswordAuthPlugin.create_auth_string(contrasena),
+                auth_plugin=NativePasswordAuthPlugin.name,
+            )
+
+    class SesionSQLite(Session):
+        def __init__(self):
+            super().__init__()
+            self.bd = sqlite3.connect(ruta, isolation_level=None, check_same_thread=False, timeout=30)
+            self.bd.create_function("DAY_OF_WEEK", 1, dia_semana_mysql)
+
+        async def query(self, expression, sql, attrs):
+            cursor = None
+            for sentencia in traducir_sqlite(expression):
+                cursor = self.bd.execute(sentencia)
+            if cursor is None or cursor.description is None:
+                return [], []
+            return cursor.fetchall(), [d[0] for d in cursor.description]
+
+        async def close(self):
+            self.bd.close()
+            await super().close()
+
+    conexion = sqlite3.connect(ruta)
+    conexion.execute("PRAGMA journal_mode=WAL")
+    conexion.close()
+
+    async def principal():
+        servidor = MysqlServer(session_factory=SesionSQLite, identity_provider=UsuarioBanco())
+        await servidor.start_server(host="127.0.0.1", port=puerto)
+        listo.set()
+        await servidor.serve_forever()
+
+    asyncio.run(principal())
+
+
+def iniciar_bd_embebida(puerto: int, ruta: str, usuario: str, contrasena: str):
+    # En otro proceso: la extensión en C de mysql-connector no suelta el GIL
+    # mientras espera la respuesta y un servidor en un hilo quedaría bloqueado.
+    import multiprocessing
+
+    contexto = multiprocessing.get_context("spawn")
+    listo = contexto.Event()
+    proceso = contexto.Process(target=servir_bd_embebida, args=(puerto, ruta, usuario, contrasena, listo), daemon=True)
+    proceso.start()
+    if not listo.wait(30):
+        proceso.terminate()
+        raise RuntimeError("La base embebida no arrancó")
+    return proceso
+
+
+def iniciar_servidor(args):
+    entorno = {
+        **os.environ,
+        "BD_HOST": args.bd_host,
+        "BD_PUERTO": str(args.bd_puerto),
+        "BD_USUARIO": args.bd_usuario,
+        "BD_CONTRASENA": args.bd_contrasena,
+        "BD_NOMBRE": args.bd_nombre,
+        "LOG_NIVEL": "WARNING",
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.puerto), "--workers", str(args.workers)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=entorno,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def esperar_listo(base: str, limite: float = 60.0) -> float:
+    """Espera a que /listo responda 200 y devuelve los segundos transcurridos."""
+    inicio = time.perf_counter()
+    while time.perf_counter() - inicio < limite:
+        try:
+            if httpx.get(f"{base}/listo", timeout=1).status_code == 200:
+                return time.perf_counter() - inicio
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("El servidor no quedó listo a tiempo")
+
+
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    # Método del rango más cercano sobre una lista ya ordenada
+    indice = max(0, min(len(valores) - 1, math.ceil(p / 100 * len(valores)) - 1))
+    return valores[indice]
+
+
+async def ejecutar_escenario(base: str, escenario: dict, duracion: float, escala: int, semilla: int) -> dict:
+    rnd = random.Random(semilla)
+    pesos = [peso for peso, _ in escenario["rutas"]]
+    plantillas = [ruta for _, ruta in escenario["rutas"]]
+    muestras = {ruta: [] for ruta in plantillas}
+    estados = {ruta: {} for ruta in plantillas}
+    fin = time.perf_counter() + duracion
+
+    async def usuario_virtual(cliente):
+        while time.perf_counter() < fin:
+            plantilla = rnd.choices(plantillas, pesos)[0]
+            url = plantilla.format(usuario=f"usuario{rnd.randrange(escala)}", id=rnd.randrange(1, escala + 1))
+            inicio = time.perf_counter()
+            try:
+                estado = (await cliente.get(url)).status_code
+            except httpx.HTTPError as e:
+                estado = type(e).__name__
+            # Solo las respuestas 2xx cuentan para la latencia: un 503 o un 500
+            # rápidos no deben verse como una mejora
+            if isinstance(estado, int) and 200 <= estado < 300:
+                muestras[plantilla].append(time.perf_counter() - inicio)
+            estados[plantilla][str(estado)] = estados[plantilla].get(str(estado), 0) + 1
+
+    limites = httpx.Limits(max_connections=escenario["concurrencia"])
+    async with httpx.AsyncClient(base_url=base, timeout=30, limits=limites) as cliente:
+        inicio = time.perf_counter()
+        await asyncio.gather(*(usuario_virtual(cliente) for _ in range(escenario["concurrencia"])))
+        transcurrido = time.perf_counter() - inicio
+
+    rutas = {}
+    for plantilla, tiempos in muestras.items():
+        peticiones = sum(estados[plantilla].values())
+        if not peticiones:
+            continue
+        tiempos.sort()
+        rutas[plantilla] = {
+            "peticiones": peticiones,
+            "por_segundo": round(peticiones / transcurrido, 2),
+            "exitosas_por_segundo": round(len(tiempos) / transcurrido, 2),
+            "tasa_error": round(1 - len(tiempos) / peticiones, 4),
+            "p50_ms": round(percentil(tiempos, 50) * 1000, 2),
+            "p95_ms": round(percentil(tiempos, 95) * 1000, 2),
+            "p99_ms": round(percentil(tiempos, 99) * 1000, 2),
+            "estados": estados[plantilla],
+        }
+    total = sum(r["peticiones"] for r in rutas.values())
+    exitosas = sum(len(t) for t in muestras.values())
+    return {
+        "concurrencia": escenario["concurrencia"],
+        "segundos": round(transcurrido, 2),
+        "por_segundo": round(total / transcurrido, 2),
+        "exitosas_por_segundo": round(exitosas / transcurrido, 2),
+        "rutas": rutas,
+    }
+
+
+def version_git() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocida"
+
+
+def comparar(actual: dict, anterior: dict, tolerancia: float, tolerancia_errores: float) -> list:
+    """
+    Rutas que empeoraron respecto a la corrida anterior: p95 de las respuestas 2xx
+    más alto o respuestas 2xx por segundo más bajas que la tolerancia (0.2 = 20 %),
+    o una tasa de respuestas que no son 2xx que subió más de `tolerancia_errores`
+    (0.01 = un punto porcentual).
+    """
+    regresiones = []
+
+    def regresion(nombre, ruta, metrica, antes, ahora):
+        regresiones.append({"escenario": nombre, "ruta": ruta, "metrica": metrica, "antes": antes, "ahora": ahora})
+
+    for nombre, escenario in actual["escenarios"].items():
+        previo = anterior.get("escenarios", {}).get(nombre)
+        if not previo:
+            continue
+        for ruta, datos in escenario["rutas"].items():
+            antes = previo["rutas"].get(ruta)
+            if not antes:
+                continue
+            if antes["p95_ms"] > 0 and datos["p95_ms"] > antes["p95_ms"] * (1 + tolerancia):
+                regresion(nombre, ruta, "p95_ms", antes["p95_ms"], datos["p95_ms"])
+            # Resultados anteriores a estas métricas no las tienen
+            if "tasa_error" in antes and datos["tasa_error"] > antes["tasa_error"] + tolerancia_errores:
+                regresion(nombre, ruta, "tasa_error", antes["tasa_error"], datos["tasa_error"])
+            if "exitosas_por_segundo" in antes and datos["exitosas_por_segundo"] < antes["exitosas_por_segundo"] * (1 - tolerancia):
+                regresion(nombre, ruta, "exitosas_por_segundo", antes["exitosas_por_segundo"], datos["exitosas_por_segundo"])
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banco de pruebas de carga de la API")
+    parser.add_argument("--bd-host", default="127.0.0.1")
+    parser.add_argument("--bd-puerto", type=int, default=3306)
+    parser.add_argument("--bd-usuario", default="root")
+    parser.add_argument("--bd-contrasena", default="cci")
+    parser.add_argument("--bd-nombre", default="cci_bench", help="Se vacía antes de sembrar; nunca usar la base de producción")
+    parser.add_argument("--bd-embebida", action="store_true", help="Usar la base embebida (mysql-mimic + SQLite) en --bd-puerto")
+    parser.add_argument("--bd-archivo", default="bench.sqlite3", help="Archivo SQLite de la base embebida")
+    parser.add_argument("--escala", type=int, default=1000, help="Número de beneficiarios sintéticos")
+    parser.add_argument("--registros-por-beneficiario", type=int, default=5)
+    parser.add_argument("--sin-sembrar", action="store_true", help="Usar los datos que ya están en la base")
+    parser.add_argument("--escenarios", default=",".join(ESCENARIOS), help="Escenarios separados por comas")
+    parser.add_argument("--duracion", type=float, default=20.0, help="Segundos por escenario")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--salida", help="Archivo JSON de resultados (por defecto stdout)")
+    parser.add_argument("--comparar", help="Resultado anterior; termina con código 1 si hay regresión")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="Empeoramiento admitido del p95 y del rendimiento")
+    parser.add_argument("--tolerancia-errores", type=float, default=0.01, help="Aumento admitido de la tasa de respuestas que no son 2xx")
+    args = parser.parse_args()
+
+    if args.bd_nombre == "cci" and not args.sin_sembrar:
+        parser.error("la base 'cci' es la de producción y sembrar la vaciaría; use otra con --bd-nombre")
+
+    bd_embebida = None
+    if args.bd_embebida:
+        bd_embebida = iniciar_bd_embebida(args.bd_puerto, args.bd_archivo, args.bd_usuario, args.bd_contrasena)
+
+    resultado = {
+        "bd": "embebida (mysql-mimic + SQLite)" if args.bd_embebida else f"mysql {args.bd_host}:{args.bd_puerto}/{args.bd_nombre}",
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "version": version_git(),
+        "escala": args.escala,
+        "workers": args.workers,
+        "duracion_escenario": args.duracion,
+    }
+    if not args.sin_sembrar:
+        resultado["datos"] = sembrar(args)
+
+    base = f"http://127.0.0.1:{args.puerto}"
+    servidor = iniciar_servidor(args)
+    try:
+        resultado["segundos_hasta_listo"] = round(esperar_listo(base), 3)
+        resultado["escenarios"] = {}
+        for nombre in args.escenarios.split(","):
+            resultado["escenarios"][nombre] = asyncio.run(
+                ejecutar_escenario(base, ESCENARIOS[nombre], args.duracion, args.escala, args.semilla)
+            )
+    finally:
+        servidor.terminate()
+        servidor.wait()
+        if bd_embebida:
+            bd_embebida.terminate()
+
+    codigo = 0
+    if args.comparar:
+        with open(args.comparar) as archivo:
+            resultado["regresiones"] = comparar(resultado, json.load(archivo), args.tolerancia, args.tolerancia_errores)
+        codigo = 1 if resultado["regresiones"] else 0
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w") as archivo:
+            archivo.write(texto + "\n")
+    else:
+        print(texto)
+    sys.exit(codigo)
+
+
+if __name__ == "__main__":
+    main()
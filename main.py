@@ -1,16 +1,17 @@
 # Librerías importadas
+import time
+INICIO_IMPORTACION = time.perf_counter()  # Para medir cuánto tarda en importarse el módulo
 from fastapi import FastAPI, HTTPException  # FastAPI para crear la API y HTTPException para manejo de errores HTTP
 from fastapi.middleware.cors import CORSMiddleware  # CORSMiddleware para permitir CORS (compartir recursos entre orígenes)
 from pydantic import BaseModel  # Pydantic para definir modelos de datos
 import mysql.connector  # Conector para interactuar con MySQL
 from fastapi.encoders import jsonable_encoder  # Para convertir los resultados a un formato JSON compatible
 from datetime import datetime, timedelta # Para manejar fechas y horas
-import qrcode
 import os
 import base64
 import io
 from typing import List, Optional
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 import jwt
 
 
@@ -24,6 +25,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Permite cualquier tipo de método HTTP
     allow_headers=["*"],  # Permite cualquier encabezado
+    # Cabeceras que el JavaScript de otro origen puede leer; X-Ultima-Escritura es
+    # la que un frontend en otro sitio reenvía para leer lo que acaba de escribir
+    expose_headers=["X-Ultima-Escritura", "X-Request-ID", "Server-Timing"],
 )
 
 
@@ -31,24 +35,1141 @@ app.add_middleware(
 
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector import pooling
+import asyncio
+import contextvars
+import functools
+import itertools
+import sys
+import threading
+from fastapi.routing import APIRoute
+from starlette.routing import Match
+import json
+from bisect import bisect_left
+import atexit
+import contextlib
+import logging
+import logging.handlers
+import queue
+import random
+import uuid
+
+
+
+
+# ---------------------------------------------------------------------------
+# Logging estructurado
+# Los endpoints solo encolan el registro (QueueHandler); un hilo en segundo
+# plano (QueueListener) lo convierte a JSON y lo escribe en stdout. Si la cola
+# se llena el registro se descarta en vez de bloquear la petición.
+# Niveles por módulo: LOG_NIVELES="cci.bd=DEBUG,cci.http=WARNING"
+# Muestreo de eventos DEBUG: LOG_MUESTREO_DEBUG=0.01 (1 de cada 100)
+# ---------------------------------------------------------------------------
+LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO")
+LOG_NIVELES = os.getenv("LOG_NIVELES", "")
+LOG_MUESTREO_DEBUG = float(os.getenv("LOG_MUESTREO_DEBUG", "0.01"))
+LOG_TAMANO_COLA = 10000
+
+id_peticion = contextvars.ContextVar("id_peticion", default=None)
+ruta_peticion = contextvars.ContextVar("ruta_peticion", default=None)
+
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        linea = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.msg,
+        }
+        if getattr(record, "id_peticion", None):
+            linea["id_peticion"] = record.id_peticion
+        if getattr(record, "ruta", None):
+            linea["ruta"] = record.ruta
+        if getattr(record, "datos", None):
+            linea.update(record.datos)
+        if record.exc_text:
+            linea["excepcion"] = record.exc_text
+        return json.dumps(linea, ensure_ascii=False, default=str)
+
+
+class ColaLog(logging.handlers.QueueHandler):
+    """Captura el contexto de la petición y encola sin formatear a JSON."""
+
+    def prepare(self, record):
+        record.id_peticion = id_peticion.get()
+        record.ruta = ruta_peticion.get()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            errores_total.inc("LogDescartado")
+
+
+class MuestreoDebug(logging.Filter):
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < LOG_MUESTREO_DEBUG
+
+
+def configurar_logging():
+    cola = queue.Queue(maxsize=LOG_TAMANO_COLA)
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormatoJSON())
+    listener = logging.handlers.QueueListener(cola, salida)
+
+    handler = ColaLog(cola)
+    handler.addFilter(MuestreoDebug())
+
+    raiz = logging.getLogger("cci")
+    raiz.setLevel(LOG_NIVEL.upper())
+    raiz.addHandler(handler)
+    raiz.propagate = False
+
+    for par in filter(None, LOG_NIVELES.split(",")):
+        modulo, _, nivel = par.partition("=")
+        logging.getLogger(modulo.strip()).setLevel(nivel.strip().upper())
+
+    listener.start()
+    atexit.register(listener.stop)
+
+
+configurar_logging()
+log_bd = logging.getLogger("cci.bd")
+log_http = logging.getLogger("cci.http")
+log_qr = logging.getLogger("cci.qr")
+log_metricas = logging.getLogger("cci.metricas")
+
+
+
+
+# ---------------------------------------------------------------------------
+# Métricas estilo Prometheus
+# Cada serie es una lista preasignada y cada hilo escribe solo en su propia
+# copia (fragmento), así no hay locks ni incrementos perdidos en el camino
+# caliente; snapshot_metricas suma los fragmentos. Con varios workers de
+# uvicorn cada proceso vuelca su copia en METRICAS_DIR y /metrics suma los
+# archivos de todos.
+# ---------------------------------------------------------------------------
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_FILAS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+METRICAS_DIR = os.getenv("METRICAS_DIR")
+METRICAS_INTERVALO = 5  # Segundos entre volcados de cada worker
+
+
+class Metrica:
+    tipo = ""
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.local = threading.local()
+        self.fragmentos = []  # Un diccionario de series por hilo
+        registro_metricas.append(self)
+
+    def serie(self, valores: tuple) -> list:
+        try:
+            series = self.local.series
+        except AttributeError:
+            series = self.local.series = {}
+            self.fragmentos.append(series)
+        serie = series.get(valores)
+        if serie is None:
+            serie = series[valores] = self.nueva_serie()
+        return serie
+
+    def nueva_serie(self) -> list:
+        return [0]
+
+    def valores(self) -> dict:
+        """Suma los fragmentos de todos los hilos."""
+        total = {}
+        for series in list(self.fragmentos):
+            # list(dict.items()) se copia de forma atómica bajo el GIL
+            for clave, serie in list(series.items()):
+                acumulado = total.get(clave)
+                total[clave] = list(serie) if acumulado is None else [a + b for a, b in zip(acumulado, serie)]
+        return total
+
+
+class Contador(Metrica):
+    tipo = "counter"
+
+    def inc(self, *valores, cantidad=1):
+        self.serie(valores)[0] += cantidad
+
+
+class Medidor(Metrica):
+    """
+    `absoluto=True` para los medidores que se fijan (estado de una réplica,
+    tiempos de arranque): entre workers se toma el máximo en vez de sumarlos.
+    """
+    tipo = "gauge"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = (), absoluto: bool = False):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.absoluto = absoluto
+        self.fijos = {}  # Valores absolutos: no se reparten entre hilos
+
+    def sumar(self, *valores, cantidad=1):
+        self.serie(valores)[0] += cantidad
+
+    def fijar(self, valor, *valores):
+        self.fijos[valores] = [valor]
+
+    def valores(self) -> dict:
+        total = super().valores()
+        total.update(dict(self.fijos))
+        return total
+
+
+class Histograma(Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = (), buckets=BUCKETS_LATENCIA):
+        self.buckets = buckets
+        super().__init__(nombre, ayuda, etiquetas)
+
+    def nueva_serie(self) -> list:
+        # Un conteo por bucket, uno para +Inf, la suma y el total
+        return [0] * (len(self.buckets) + 3)
+
+    def observar(self, valor: float, *valores):
+        serie = self.serie(valores)
+        serie[bisect_left(self.buckets, valor)] += 1
+        serie[-2] += valor
+        serie[-1] += 1
+
 
-def get_db_connection():
+registro_metricas = []
+
+peticiones_segundos = Histograma("cci_peticiones_segundos", "Latencia de las peticiones HTTP", ("ruta", "metodo", "estado"))
+peticiones_en_curso = Medidor("cci_peticiones_en_curso", "Peticiones HTTP en curso")
+errores_total = Contador("cci_errores_total", "Errores por tipo", ("tipo",))
+consultas_segundos = Histograma("cci_consultas_segundos", "Latencia de las consultas SQL con nombre", ("consulta",))
+consultas_filas = Histograma("cci_consultas_filas", "Filas devueltas o afectadas por consulta", ("consulta",), BUCKETS_FILAS)
+conexion_bd_segundos = Histograma("cci_conexion_bd_segundos", "Tiempo para obtener una conexión a la base de datos", ("destino",))
+conexiones_bd_total = Contador("cci_bd_conexiones_total", "Conexiones entregadas por destino y origen (pool o directa)", ("destino", "origen"))
+bd_conexiones_en_uso = Medidor("cci_bd_conexiones_en_uso", "Conexiones prestadas por destino", ("destino",))
+bd_destino_sano = Medidor("cci_bd_destino_sano", "1 si la réplica está disponible para lecturas", ("destino",), absoluto=True)
+bd_retraso_replica = Medidor("cci_bd_replica_retraso_segundos", "Retraso de replicación medido", ("destino",), absoluto=True)
+qr_render_segundos = Histograma("cci_qr_render_segundos", "Tiempo de generación de los códigos QR")
+arranque_segundos = Medidor("cci_arranque_segundos", "Tiempos de arranque del worker", ("worker", "fase"), absoluto=True)
+
+
+def snapshot_metricas() -> dict:
+    return {m.nombre: [[list(k), v] for k, v in m.valores().items()] for m in registro_metricas}
+
+
+def volcar_metricas():
+    if not METRICAS_DIR:
+        return
+    ruta = os.path.join(METRICAS_DIR, f"{os.getpid()}.json")
+    temporal = ruta + ".tmp"
+    with open(temporal, "w") as archivo:
+        json.dump(snapshot_metricas(), archivo)
+    os.replace(temporal, ruta)
+
+
+def proceso_vivo(pid: int) -> bool:
     try:
-        connection = mysql.connector.connect(
-            host="10.0.1.56",
-            port=3306,
-            user="BryanAdmin",
-            password="BryManu28180503.",
-            database="cci"
-        )
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
 
-        if connection.is_connected():
-            print("Conexión exitosa")
-            return connection
 
-    except Error as e:
-        print("Error en la conexión:", e)
+def pid_volcado(archivo: str):
+    """Pid del worker dueño de un volcado (<pid>.json); None para cualquier otro archivo."""
+    nombre, extension = os.path.splitext(archivo)
+    if extension != ".json" or not nombre.isdigit():
         return None
+    return int(nombre)
+
+
+def combinar_metricas() -> dict:
+    """
+    Suma las series de todos los workers (o solo las locales si no hay METRICAS_DIR).
+    Los medidores absolutos no se suman: cada worker mide lo mismo y se toma el máximo.
+    """
+    if not METRICAS_DIR:
+        return snapshot_metricas()
+    volcar_metricas()
+    medidores = {m.nombre for m in registro_metricas if isinstance(m, Medidor)}
+    absolutos = {m.nombre for m in registro_metricas if isinstance(m, Medidor) and m.absoluto}
+    total = {}
+    for archivo in os.listdir(METRICAS_DIR):
+        pid = pid_volcado(archivo)
+        if pid is None:
+            continue
+        vivo = proceso_vivo(pid)
+        try:
+            with open(os.path.join(METRICAS_DIR, archivo)) as f:
+                datos = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for nombre, series in datos.items():
+            # Los medidores de workers que ya terminaron no cuentan
+            if nombre in medidores and not vivo:
+                continue
+            destino = total.setdefault(nombre, {})
+            for etiquetas, valores in series:
+                clave = tuple(etiquetas)
+                if clave in destino and nombre in absolutos:
+                    destino[clave] = [max(a, b) for a, b in zip(destino[clave], valores)]
+                elif clave in destino:
+                    destino[clave] = [a + b for a, b in zip(destino[clave], valores)]
+                else:
+                    destino[clave] = valores
+    return {nombre: [[list(k), v] for k, v in series.items()] for nombre, series in total.items()}
+
+
+def escapar_etiqueta(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formato_etiquetas(nombres, valores, extra: str = "") -> str:
+    partes = [f'{n}="{escapar_etiqueta(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+
+def exportar_metricas() -> str:
+    datos = combinar_metricas()
+    lineas = []
+    for m in registro_metricas:
+        lineas.append(f"# HELP {m.nombre} {m.ayuda}")
+        lineas.append(f"# TYPE {m.nombre} {m.tipo}")
+        for etiquetas, valores in datos.get(m.nombre, []):
+            if isinstance(m, Histograma):
+                acumulado = 0
+                for limite, conteo in zip(m.buckets + ("+Inf",), valores):
+                    acumulado += conteo
+                    le = 'le="%s"' % limite
+                    lineas.append(f"{m.nombre}_bucket{formato_etiquetas(m.etiquetas, etiquetas, le)} {acumulado}")
+                lineas.append(f"{m.nombre}_sum{formato_etiquetas(m.etiquetas, etiquetas)} {valores[-2]}")
+                lineas.append(f"{m.nombre}_count{formato_etiquetas(m.etiquetas, etiquetas)} {valores[-1]}")
+            else:
+                lineas.append(f"{m.nombre}{formato_etiquetas(m.etiquetas, etiquetas)} {valores[0]}")
+    return "\n".join(lineas) + "\n"
+
+
+def hilo_volcado_metricas():
+    while True:
+        time.sleep(METRICAS_INTERVALO)
+        try:
+            volcar_metricas()
+        except OSError as e:
+            log_metricas.warning("error al volcar métricas", extra={"datos": {"error": str(e)}})
+
+
+def limpiar_metricas_antiguas():
+    """
+    Borra los volcados de procesos que ya no existen (despliegues anteriores) y
+    el de un pid reutilizado por este worker, para no sumar contadores viejos.
+    """
+    for archivo in os.listdir(METRICAS_DIR):
+        pid = pid_volcado(archivo)
+        if pid is None:
+            continue
+        if pid == os.getpid() or not proceso_vivo(pid):
+            try:
+                os.remove(os.path.join(METRICAS_DIR, archivo))
+            except OSError:
+                pass
+
+
+if METRICAS_DIR:
+    os.makedirs(METRICAS_DIR, exist_ok=True)
+    limpiar_metricas_antiguas()
+    threading.Thread(target=hilo_volcado_metricas, daemon=True).start()
+
+
+def consulta(nombre: str, cursor, sql: str, params=None, obtener: str = None):
+    """
+    Ejecuta una consulta SQL con nombre y registra su latencia y número de filas.
+    `obtener` puede ser "uno", "todos" o None (sentencias de escritura).
+    """
+    inicio = time.perf_counter()
+    cursor.execute(sql, params)
+    if obtener == "uno":
+        resultado = cursor.fetchone()
+        filas = 1 if resultado else 0
+    elif obtener == "todos":
+        resultado = cursor.fetchall()
+        filas = len(resultado)
+    else:
+        resultado = None
+        filas = max(cursor.rowcount, 0)
+    duracion = time.perf_counter() - inicio
+    consultas_segundos.observar(duracion, nombre)
+    registrar_tiempo(f"sql_{nombre}", duracion)
+    consultas_filas.observar(filas, nombre)
+    return resultado
+
+
+def consulta_lote(nombre: str, cursor, sql: str, filas: list):
+    """executemany con nombre; no hace nada si no hay filas."""
+    if not filas:
+        return
+    inicio = time.perf_counter()
+    cursor.executemany(sql, filas)
+    duracion = time.perf_counter() - inicio
+    consultas_segundos.observar(duracion, nombre)
+    registrar_tiempo(f"sql_{nombre}", duracion)
+    consultas_filas.observar(len(filas), nombre)
+
+
+# ---------------------------------------------------------------------------
+# Server-Timing y perfilado bajo demanda
+# Cada petición guarda en un contextvar la lista de tiempos (conexión, cada
+# consulta, serialización, QR) y se devuelve en la cabecera Server-Timing.
+# Un administrador puede pedir que una sola petición se ejecute bajo un
+# perfilador por muestreo enviando su token en la cabecera X-Perfilar (nunca en
+# la URL, que queda en los logs de acceso); el perfil se guarda en formato
+# "folded" (flamegraph.pl, speedscope) en PERFILES_DIR y solo se conservan los
+# PERFILES_MAX más recientes.
+# ---------------------------------------------------------------------------
+PERFILES_DIR = os.getenv("PERFILES_DIR", "perfiles")
+PERFILES_MAX = int(os.getenv("PERFILES_MAX", "50"))
+PERFIL_INTERVALO = 0.005  # Segundos entre muestras
+ROLES_PERFIL = {"admin", "administrador"}
+
+tiempos_peticion = contextvars.ContextVar("tiempos_peticion", default=None)
+perfil_actual = contextvars.ContextVar("perfil_actual", default=None)
+# Cuándo terminó el endpoint y cuánto llevó codificar(); lo prepara RutaMedida
+medicion_ruta = contextvars.ContextVar("medicion_ruta", default=None)
+perfilando = threading.Semaphore(1)  # Un solo perfil a la vez para acotar el costo
+
+
+def registrar_tiempo(nombre: str, segundos: float):
+    tiempos = tiempos_peticion.get()
+    if tiempos is not None:
+        tiempos.append((nombre, segundos))
+
+
+def codificar(datos):
+    """jsonable_encoder medido para Server-Timing (se suma a la serialización de la ruta)."""
+    inicio = time.perf_counter()
+    resultado = jsonable_encoder(datos)
+    duracion = time.perf_counter() - inicio
+    medicion = medicion_ruta.get()
+    if medicion is not None:
+        medicion["serializacion"] += duracion
+    else:
+        registrar_tiempo("serializacion", duracion)
+    return resultado
+
+
+def cabecera_server_timing(tiempos) -> str:
+    return ", ".join(f"{nombre};dur={segundos * 1000:.2f}" for nombre, segundos in tiempos)
+
+
+class PerfilMuestreo:
+    """Toma muestras de la pila de los hilos que atienden una petición."""
+
+    def __init__(self):
+        self.hilos = {threading.get_ident()}
+        self.muestras = {}
+        self.activo = True
+        self.hilo = threading.Thread(target=self.muestrear, daemon=True)
+
+    def iniciar(self):
+        self.hilo.start()
+
+    def detener(self):
+        self.activo = False
+        self.hilo.join()
+
+    def muestrear(self):
+        while self.activo:
+            frames = sys._current_frames()
+            for ident in list(self.hilos):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                pila = []
+                while frame is not None:
+                    codigo = frame.f_code
+                    pila.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)})")
+                    frame = frame.f_back
+                clave = ";".join(reversed(pila))
+                self.muestras[clave] = self.muestras.get(clave, 0) + 1
+            time.sleep(PERFIL_INTERVALO)
+
+    def guardar(self, ruta: str) -> str:
+        os.makedirs(PERFILES_DIR, exist_ok=True)
+        nombre = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{ruta or 'raiz'}.folded"
+        with open(os.path.join(PERFILES_DIR, nombre), "w") as archivo:
+            for pila, cantidad in self.muestras.items():
+                archivo.write(f"{pila} {cantidad}\n")
+        limpiar_perfiles()
+        return nombre
+
+
+def limpiar_perfiles():
+    archivos = sorted(f for f in os.listdir(PERFILES_DIR) if f.endswith(".folded"))
+    for archivo in archivos[:-PERFILES_MAX]:
+        try:
+            os.remove(os.path.join(PERFILES_DIR, archivo))
+        except OSError:
+            pass
+
+
+def es_administrador(token: str) -> bool:
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        return False
+    return payload.get("rol") in ROLES_PERFIL
+
+
+class RutaMedida(APIRoute):
+    """
+    Envuelve los endpoints síncronos para que los logs del endpoint lleven la
+    plantilla de la ruta (/obtener_qr/{usuario}, nunca el usuario) y para que, si
+    la petición se está perfilando, el hilo del threadpool también sea muestreado.
+    También mide la serialización de la respuesta: lo que tarda FastAPI desde que
+    el endpoint devuelve hasta tener la respuesta lista (serialize_response y el
+    JSON), más las llamadas a codificar() dentro del endpoint.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not asyncio.iscoroutinefunction(endpoint):
+            endpoint = self.envolver(endpoint, path)
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self):
+        manejador = super().get_route_handler()
+
+        async def manejador_medido(request):
+            medicion = {"serializacion": 0.0, "fin_endpoint": None}
+            medicion_ruta.set(medicion)
+            response = await manejador(request)
+            if medicion["fin_endpoint"] is not None:
+                medicion["serializacion"] += time.perf_counter() - medicion["fin_endpoint"]
+                registrar_tiempo("serializacion", medicion["serializacion"])
+            return response
+
+        return manejador_medido
+
+    @staticmethod
+    def envolver(endpoint, path: str):
+        def ejecutar(*args, **kwargs):
+            resultado = endpoint(*args, **kwargs)
+            medicion = medicion_ruta.get()
+            if medicion is not None:
+                medicion["fin_endpoint"] = time.perf_counter()
+            return resultado
+
+        @functools.wraps(endpoint)
+        def envoltura(*args, **kwargs):
+            ruta_peticion.set(path)
+            perfil = perfil_actual.get()
+            if perfil is None:
+                return ejecutar(*args, **kwargs)
+            ident = threading.get_ident()
+            perfil.hilos.add(ident)
+            try:
+                return ejecutar(*args, **kwargs)
+            finally:
+                perfil.hilos.discard(ident)
+        return envoltura
+
+
+app.router.route_class = RutaMedida
+
+
+# Segundos máximos para abrir una conexión antes de darla por fallida
+TIEMPO_CONEXION_BD = 3
+
+# Conexiones que se abren al arrancar y se reutilizan entre peticiones (por destino)
+POOL_TAMANO = int(os.getenv("POOL_TAMANO", "8"))
+
+CONFIG_BD = {
+    "host": os.getenv("BD_HOST", "10.0.1.56"),
+    "port": int(os.getenv("BD_PUERTO", "3306")),
+    "user": os.getenv("BD_USUARIO", "BryanAdmin"),
+    "password": os.getenv("BD_CONTRASENA", "BryManu28180503."),
+    "database": os.getenv("BD_NOMBRE", "cci"),
+    "connection_timeout": TIEMPO_CONEXION_BD,
+}
+
+# Réplicas de solo lectura: BD_REPLICAS="10.0.1.57,10.0.1.58:3307" (mismas credenciales)
+BD_REPLICAS = os.getenv("BD_REPLICAS", "")
+MAX_RETRASO_REPLICA = float(os.getenv("MAX_RETRASO_REPLICA", "5"))  # Segundos
+INTERVALO_RETRASO = 2  # Segundos entre revisiones del retraso de las réplicas
+# Tras escribir, la misma sesión lee de la primaria durante esta ventana
+VENTANA_LECTURA_PROPIA = MAX_RETRASO_REPLICA + 2 * INTERVALO_RETRASO
+COOKIE_ESCRITURA = "cci_escritura"
+
+# Estado de lectura/escritura de la petición en curso (lo prepara control_admision)
+sesion_bd = contextvars.ContextVar("sesion_bd", default=None)
+
+# Conexiones abiertas por la petición en curso; se devuelven al pool al terminar
+conexiones_peticion = contextvars.ContextVar("conexiones_peticion", default=None)
+
+# Circuito del que la petición en curso es el intento de prueba (semiabierto)
+sonda_circuito = contextvars.ContextVar("sonda_circuito", default=None)
+
+
+class BDNoDisponible(Error):
+    """Se lanza cuando el circuito de la base de datos está abierto."""
+
+
+class CircuitoBD:
+    """
+    Circuit breaker alrededor de la apertura de conexiones.
+    Tras `max_fallos` errores seguidos se abre durante `tiempo_abierto` segundos y
+    rechaza al instante; luego deja pasar un solo intento de prueba (semiabierto).
+    Mientras la prueba no tenga éxito, el circuito sigue abierto para los demás.
+    """
+
+    def __init__(self, max_fallos: int = 5, tiempo_abierto: float = 10.0):
+        self.max_fallos = max_fallos
+        self.tiempo_abierto = tiempo_abierto
+        self.fallos = 0
+        self.abierto_hasta = 0.0
+        self.probando = False
+        self.lock = threading.Lock()
+
+    def segundos_restantes(self) -> float:
+        return max(0.0, self.abierto_hasta - time.monotonic())
+
+    def esta_abierto(self) -> bool:
+        # Abierto o semiabierto: en ambos casos se rechaza a todos salvo a la prueba
+        return self.fallos >= self.max_fallos
+
+    def reservar_prueba(self) -> bool:
+        """Marca la petición actual como el intento de prueba si ya toca probar."""
+        with self.lock:
+            if self.fallos < self.max_fallos or self.segundos_restantes() > 0 or self.probando:
+                return False
+            self.probando = True
+            sonda_circuito.set(self)
+            return True
+
+    def liberar_prueba(self):
+        # La prueba terminó sin llegar a conectar (p. ej. un 422): otra petición puede probar
+        with self.lock:
+            self.probando = False
+
+    def permitir(self) -> bool:
+        with self.lock:
+            if self.fallos < self.max_fallos:
+                return True
+            if sonda_circuito.get() is self:
+                return True
+            if self.segundos_restantes() > 0 or self.probando:
+                return False
+            self.probando = True  # Semiabierto fuera de una petición (calentamiento, réplicas)
+            return True
+
+    def registrar_exito(self):
+        with self.lock:
+            self.fallos = 0
+            self.probando = False
+
+    def registrar_fallo(self):
+        with self.lock:
+            self.fallos += 1
+            self.probando = False
+            if self.fallos >= self.max_fallos:
+                self.abierto_hasta = time.monotonic() + self.tiempo_abierto
+
+
+class DestinoBD:
+    """Una instancia de MySQL (primaria o réplica) con su pool y su circuito."""
+
+    def __init__(self, nombre: str, config: dict):
+        self.nombre = nombre
+        self.config = config
+        self.pool = None
+        self.circuito = CircuitoBD()
+        self.sano = True
+        self.retraso = 0.0
+        bd_destino_sano.fijar(1, nombre)
+
+    def crear_pool(self):
+        if self.pool is None:
+            self.pool = pooling.MySQLConnectionPool(pool_name=f"cci_{self.nombre}", pool_size=POOL_TAMANO, **self.config)
+
+    def marcar(self, sano: bool, retraso: float = None):
+        if sano != self.sano:
+            log_bd.warning("cambio de estado de réplica", extra={"datos": {"destino": self.nombre, "sano": sano, "retraso": retraso}})
+        self.sano = sano
+        self.retraso = retraso
+        bd_destino_sano.fijar(int(sano), self.nombre)
+        if retraso is not None:
+            bd_retraso_replica.fijar(retraso, self.nombre)
+
+
+def crear_replicas() -> list:
+    replicas = []
+    for i, direccion in enumerate(filter(None, (d.strip() for d in BD_REPLICAS.split(",")))):
+        host, _, puerto = direccion.partition(":")
+        config = {**CONFIG_BD, "host": host, "port": int(puerto or CONFIG_BD["port"])}
+        replicas.append(DestinoBD(f"replica{i + 1}", config))
+    return replicas
+
+
+bd_primaria = DestinoBD("primaria", CONFIG_BD)
+bd_replicas = crear_replicas()
+turno_replica = itertools.count()
+
+# El control de admisión usa el circuito de la primaria
+circuito_bd = bd_primaria.circuito
+
+
+def replicas_sanas() -> list:
+    return [r for r in bd_replicas if r.sano and not r.circuito.esta_abierto()]
+
+
+def elegir_destino(lectura: bool) -> DestinoBD:
+    sesion = sesion_bd.get()
+    if not lectura or (sesion is not None and sesion["forzar_primaria"]):
+        return bd_primaria
+    sanas = replicas_sanas()
+    if not sanas:
+        return bd_primaria
+    return sanas[next(turno_replica) % len(sanas)]
+
+
+def conectar(destino: DestinoBD):
+    if not destino.circuito.permitir():
+        errores_total.inc("BDNoDisponible")
+        raise BDNoDisponible(msg="Base de datos no disponible, intente más tarde")
+    inicio = time.perf_counter()
+    connection = None
+    origen = "directa"
+    try:
+        if destino.pool is not None:
+            try:
+                connection = destino.pool.get_connection()
+                origen = "pool"
+            except pooling.PoolError:
+                pass  # Pool agotado: se abre una conexión directa
+            except Error as e:
+                # La conexión del pool quedó en mal estado (p. ej. un resultado sin
+                # leer); es culpa de esa conexión, no de la base: no cuenta para el circuito
+                errores_total.inc("ConexionPoolInvalida")
+                log_bd.warning("conexión del pool inválida", extra={"datos": {"destino": destino.nombre, "error": str(e)}})
+        if connection is None:
+            connection = mysql.connector.connect(**destino.config)
+    except Error as e:
+        destino.circuito.registrar_fallo()
+        errores_total.inc(type(e).__name__)
+        log_bd.warning("error en la conexión", extra={"datos": {"destino": destino.nombre, "error": str(e)}})
+        raise
+
+    duracion = time.perf_counter() - inicio
+    conexion_bd_segundos.observar(duracion, destino.nombre)
+    conexiones_bd_total.inc(destino.nombre, origen)
+    bd_conexiones_en_uso.sumar(destino.nombre)
+    registrar_tiempo("bd_conexion", duracion)
+    destino.circuito.registrar_exito()
+    log_bd.debug("conexión exitosa", extra={"datos": {"destino": destino.nombre, "bd_conexion_ms": round(duracion * 1000, 2)}})
+    conexiones = conexiones_peticion.get()
+    if conexiones is not None:
+        conexiones.append((destino, connection))
+    return connection
+
+
+def get_db_connection(lectura: bool = False):
+    """
+    Devuelve una conexión a la primaria, o a una réplica sana si `lectura` es True.
+    Si la réplica falla se usa la primaria.
+    """
+    destino = elegir_destino(lectura)
+    sesion = sesion_bd.get()
+    if destino is bd_primaria:
+        if sesion is not None:
+            sesion["uso_primaria"] = True
+        return conectar(bd_primaria)
+    try:
+        return conectar(destino)
+    except Error:
+        destino.marcar(False)
+        if sesion is not None:
+            sesion["uso_primaria"] = True
+        return conectar(bd_primaria)
+
+
+def cerrar_conexiones(conexiones):
+    for destino, conexion in conexiones:
+        bd_conexiones_en_uso.sumar(destino.nombre, cantidad=-1)
+        cruda = getattr(conexion, "_cnx", None)  # La conexión real detrás de la del pool
+        try:
+            conexion.close()
+        except Error as e:
+            log_bd.warning("error al cerrar la conexión", extra={"datos": {"destino": destino.nombre, "error": str(e)}})
+            # El pool la recibe igual aunque no se pudo limpiar: se cierra la conexión
+            # real para que el pool la vuelva a abrir en vez de entregarla rota
+            if cruda is not None:
+                try:
+                    cruda.close()
+                except Error:
+                    pass
+
+
+def medir_retraso(destino: DestinoBD):
+    """Segundos de retraso de una réplica; 0 si el servidor no replica (entorno local)."""
+    conexion = conectar(destino)
+    try:
+        cursor = conexion.cursor(dictionary=True)
+        try:
+            cursor.execute("SHOW REPLICA STATUS")
+        except mysql.connector.ProgrammingError:
+            cursor.execute("SHOW SLAVE STATUS")  # MySQL anterior a 8.0.22
+        estado = cursor.fetchone()
+        cursor.close()
+    finally:
+        conexion.close()
+        bd_conexiones_en_uso.sumar(destino.nombre, cantidad=-1)
+    if estado is None:
+        return 0.0
+    retraso = estado.get("Seconds_Behind_Source", estado.get("Seconds_Behind_Master"))
+    return None if retraso is None else float(retraso)
+
+
+def vigilar_replicas():
+    while True:
+        for replica in bd_replicas:
+            try:
+                retraso = medir_retraso(replica)
+            except Error as e:
+                log_bd.debug("réplica sin respuesta", extra={"datos": {"destino": replica.nombre, "error": str(e)}})
+                replica.marcar(False)
+                continue
+            # retraso None: la replicación está detenida
+            replica.marcar(retraso is not None and retraso <= MAX_RETRASO_REPLICA, retraso)
+        time.sleep(INTERVALO_RETRASO)
+
+
+# Control de admisión: cada ruta tiene un máximo de peticiones simultáneas,
+# una cola de espera acotada y un tiempo máximo de espera en la cola.
+class LimiteRuta:
+    def __init__(self, concurrencia: int, cola: int, espera: float):
+        self.semaforo = asyncio.Semaphore(concurrencia)
+        self.cola = cola
+        self.espera = espera
+        self.esperando = 0
+
+    async def entrar(self) -> bool:
+        if self.esperando >= self.cola and self.semaforo.locked():
+            return False
+        self.esperando += 1
+        try:
+            await asyncio.wait_for(self.semaforo.acquire(), timeout=self.espera)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.esperando -= 1
+
+    def salir(self):
+        self.semaforo.release()
+
+
+# Rutas críticas de portería: más capacidad y más paciencia en la cola
+RUTAS_CRITICAS = {"obtener_qr", "puestos"}
+
+LIMITES_RUTAS = {
+    "obtener_qr": LimiteRuta(concurrencia=16, cola=64, espera=2.0),
+    "puestos": LimiteRuta(concurrencia=16, cola=64, espera=2.0),
+    # Listados de administración: pesados, pocos a la vez y se descartan rápido
+    "mostrarbeneficiarios": LimiteRuta(concurrencia=2, cola=4, espera=0.5),
+    "mostrarempleados": LimiteRuta(concurrencia=2, cola=4, espera=0.5),
+    "mostraregingresosalida": LimiteRuta(concurrencia=2, cola=4, espera=0.5),
+    "grafico": LimiteRuta(concurrencia=2, cola=4, espera=0.5),
+}
+
+# Todas las rutas no críticas comparten este cupo, así nunca ocupan
+# todos los hilos del servidor y siempre queda espacio para la portería.
+limite_no_criticas = LimiteRuta(concurrencia=12, cola=24, espera=1.0)
+
+# Rutas que no tocan la base de datos (no se ven afectadas por el circuito)
+RUTAS_SIN_BD = {"verify_token", "verify_token_app", "metrics", "listo", "docs", "openapi.json", "redoc"}
+
+# Rutas que piden get_db_connection(lectura=True): con una réplica sana siguen
+# atendiendo aunque el circuito de la primaria esté abierto
+RUTAS_LECTURA = {
+    "mostrarempleados", "mostrarbeneficiarios", "mostraregingresosalida",
+    "ingreso_dia", "salida_dia", "total_bene", "grafico",
+}
+
+RETRY_AFTER_SEGUNDOS = 1
+
+
+def respuesta_saturado(detalle: str, reintentar: float = RETRY_AFTER_SEGUNDOS):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": detalle},
+        headers={"Retry-After": str(max(1, int(reintentar + 0.999)))}
+    )
+
+
+def escribio_hace_poco(request) -> bool:
+    """Lectura de lo propio: si la sesión escribió hace poco, se lee de la primaria."""
+    valor = request.cookies.get(COOKIE_ESCRITURA) or request.headers.get("X-Ultima-Escritura")
+    try:
+        return time.time() - float(valor) < VENTANA_LECTURA_PROPIA
+    except (TypeError, ValueError):
+        return False
+
+
+def marcar_escritura(response):
+    ahora = f"{time.time():.3f}"
+    response.headers["X-Ultima-Escritura"] = ahora
+    response.set_cookie(COOKIE_ESCRITURA, ahora, max_age=int(VENTANA_LECTURA_PROPIA) + 1, httponly=True, samesite="lax")
+
+
+@app.middleware("http")
+async def control_admision(request, call_next):
+    ruta = request.url.path.strip("/").split("/")[0]
+    sesion = {"forzar_primaria": escribio_hace_poco(request), "uso_primaria": False}
+    en_replica = ruta in RUTAS_LECTURA and not sesion["forzar_primaria"] and bool(replicas_sanas())
+
+    prueba = False
+    if ruta not in RUTAS_SIN_BD and not en_replica and circuito_bd.esta_abierto():
+        prueba = circuito_bd.reservar_prueba()
+        if not prueba:
+            return respuesta_saturado("Base de datos no disponible", circuito_bd.segundos_restantes())
+
+    limites = []
+    if ruta in LIMITES_RUTAS:
+        limites.append(LIMITES_RUTAS[ruta])
+    if ruta not in RUTAS_CRITICAS and ruta not in RUTAS_SIN_BD:
+        limites.append(limite_no_criticas)
+
+    adquiridos = []
+    conexiones = []
+    conexiones_peticion.set(conexiones)
+    sesion_bd.set(sesion)
+    try:
+        for limite in limites:
+            if not await limite.entrar():
+                return respuesta_saturado("Servidor saturado, intente más tarde")
+            adquiridos.append(limite)
+        try:
+            response = await call_next(request)
+        except Error as e:
+            # Un endpoint que no atrapa el error de la base de datos: 503 con
+            # Retry-After en vez de un 500 sin cuerpo o la conexión cortada
+            log_bd.warning("error de base de datos sin atrapar", extra={"datos": {"error": str(e)}})
+            return respuesta_saturado("Base de datos no disponible", circuito_bd.segundos_restantes())
+        # Si la base de datos cayó durante la petición, responder 503 en vez de 500
+        if response.status_code == 500 and circuito_bd.esta_abierto():
+            return respuesta_saturado("Base de datos no disponible", circuito_bd.segundos_restantes())
+        if request.method != "GET" and sesion["uso_primaria"] and response.status_code < 400:
+            marcar_escritura(response)
+        return response
+    finally:
+        if prueba and circuito_bd.probando:
+            circuito_bd.liberar_prueba()
+        # Devolver al pool las conexiones que el endpoint haya dejado abiertas
+        if conexiones:
+            await asyncio.to_thread(cerrar_conexiones, conexiones)
+        for limite in adquiridos:
+            limite.salir()
+
+
+def plantilla_ruta(scope) -> str:
+    """
+    Plantilla de la ruta (/obtener_qr/{usuario}), nunca la ruta concreta. Las
+    peticiones que control_admision rechaza no llegan al router y no tienen
+    scope["route"]: se busca la ruta igual que lo haría el router.
+    """
+    route = scope.get("route")
+    if route is None:
+        route = next((r for r in app.router.routes if r.matches(scope)[0] != Match.NONE), None)
+    return route.path if route is not None else "sin_ruta"
+
+
+# Se registra después de control_admision para quedar por fuera y medir también los 503
+@app.middleware("http")
+async def medir_peticiones(request, call_next):
+    inicio = time.perf_counter()
+    peticiones_en_curso.sumar()
+    estado = 500
+    try:
+        response = await call_next(request)
+        estado = response.status_code
+        return response
+    except Exception as e:
+        errores_total.inc(type(e).__name__)
+        raise
+    finally:
+        peticiones_en_curso.sumar(cantidad=-1)
+        # Se usa la plantilla de la ruta (/obtener_qr/{usuario}) para no disparar la cardinalidad
+        peticiones_segundos.observar(time.perf_counter() - inicio, plantilla_ruta(request.scope), request.method, str(estado))
+        if estado >= 500:
+            errores_total.inc(f"HTTP{estado}")
+
+
+# Se registra antes de server_timing para quedar por dentro y ver sus tiempos
+@app.middleware("http")
+async def registrar_peticiones(request, call_next):
+    id_peticion.set(request.headers.get("X-Request-ID") or uuid.uuid4().hex)
+    inicio = time.perf_counter()
+    estado = 500
+    try:
+        response = await call_next(request)
+        estado = response.status_code
+        response.headers["X-Request-ID"] = id_peticion.get()
+        return response
+    finally:
+        if estado_arranque["primera_peticion"] is None and request.url.path not in ("/listo", "/metrics"):
+            registrar_fase("primera_peticion", time.perf_counter() - INICIO_IMPORTACION, PRESUPUESTO_PRIMERA_PETICION)
+        # Solo la plantilla de la ruta: la ruta concreta puede llevar datos personales
+        ruta_peticion.set(plantilla_ruta(request.scope))
+        tiempos = tiempos_peticion.get() or []
+        log_http.info("peticion", extra={"datos": {
+            "metodo": request.method,
+            "estado": estado,
+            "latencia_ms": round((time.perf_counter() - inicio) * 1000, 2),
+            "bd_ms": round(sum(s for n, s in tiempos if n == "bd_conexion" or n.startswith("sql_")) * 1000, 2),
+        }})
+
+
+@app.middleware("http")
+async def server_timing(request, call_next):
+    tiempos = []
+    tiempos_peticion.set(tiempos)
+
+    perfil = None
+    token = request.headers.get("X-Perfilar")
+    if token and es_administrador(token) and perfilando.acquire(blocking=False):
+        perfil = PerfilMuestreo()
+        perfil_actual.set(perfil)
+        perfil.iniciar()
+
+    inicio = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        if perfil is not None:
+            perfil.detener()
+            perfilando.release()
+
+    tiempos.append(("total", time.perf_counter() - inicio))
+    response.headers["Server-Timing"] = cabecera_server_timing(tiempos)
+    if perfil is not None:
+        ruta = request.url.path.strip("/").split("/")[0]
+        response.headers["X-Perfil"] = await asyncio.to_thread(perfil.guardar, ruta)
+    return response
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(exportar_metricas(), media_type="text/plain; version=0.0.4")
+
+
+
+
+
+# ---------------------------------------------------------------------------
+# Arranque: el worker abre el pool y genera un QR de prueba antes de aceptar
+# tráfico. /listo responde 503 hasta que el calentamiento termina. Los tiempos
+# de importación, calentamiento y primera petición se publican en /metrics y
+# se comparan con los presupuestos para detectar regresiones entre versiones.
+# ---------------------------------------------------------------------------
+PRESUPUESTO_IMPORTACION = float(os.getenv("PRESUPUESTO_IMPORTACION", "1.5"))
+PRESUPUESTO_PRIMERA_PETICION = float(os.getenv("PRESUPUESTO_PRIMERA_PETICION", "5.0"))
+REINTENTO_CALENTAMIENTO = 5  # Segundos entre intentos si la base de datos no responde
+
+log_arranque = logging.getLogger("cci.arranque")
+
+estado_arranque = {"listo": False, "importacion": None, "calentamiento": None, "primera_peticion": None}
+
+
+def registrar_fase(fase: str, segundos: float, presupuesto: float = None):
+    estado_arranque[fase] = round(segundos, 4)
+    arranque_segundos.fijar(segundos, str(os.getpid()), fase)
+    datos = {"fase": fase, "segundos": round(segundos, 4)}
+    if presupuesto is not None and segundos > presupuesto:
+        log_arranque.warning("presupuesto de arranque excedido", extra={"datos": {**datos, "presupuesto": presupuesto}})
+    else:
+        log_arranque.info("fase de arranque", extra={"datos": datos})
+
+
+def probar_destino(destino: DestinoBD):
+    destino.crear_pool()
+    # Consulta de prueba para dejar en caliente la conexión y el servidor
+    conexion = destino.pool.get_connection()
+    try:
+        cursor = conexion.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+    finally:
+        conexion.close()
+
+
+def calentar():
+    probar_destino(bd_primaria)
+
+    # Las réplicas no bloquean el arranque: si fallan se lee de la primaria
+    for replica in bd_replicas:
+        try:
+            probar_destino(replica)
+        except Error as e:
+            log_arranque.warning("réplica no disponible al arrancar", extra={"datos": {"destino": replica.nombre, "error": str(e)}})
+            replica.marcar(False)
+
+    # QR de prueba: carga qrcode, PIL y el codificador PNG
+    import qrcode
+    qrcode.make("calentamiento").save(io.BytesIO(), format="PNG")
+
+
+async def intentar_calentamiento() -> bool:
+    inicio = time.perf_counter()
+    try:
+        await asyncio.to_thread(calentar)
+    except Error as e:
+        log_arranque.warning("calentamiento fallido", extra={"datos": {"error": str(e)}})
+        return False
+    registrar_fase("calentamiento", time.perf_counter() - inicio)
+    estado_arranque["listo"] = True
+    return True
+
+
+async def reintentar_calentamiento():
+    while not await intentar_calentamiento():
+        await asyncio.sleep(REINTENTO_CALENTAMIENTO)
+
+
+@contextlib.asynccontextmanager
+async def ciclo_vida(app):
+    registrar_fase("importacion", TIEMPO_IMPORTACION, PRESUPUESTO_IMPORTACION)
+    tarea = None
+    if bd_replicas:
+        threading.Thread(target=vigilar_replicas, daemon=True).start()
+    # Si la base de datos no responde el worker arranca igual, pero /listo sigue en 503
+    if not await intentar_calentamiento():
+        tarea = asyncio.create_task(reintentar_calentamiento())
+    yield
+    if tarea is not None:
+        tarea.cancel()
+
+
+app.router.lifespan_context = ciclo_vida
+
+
+@app.get("/listo")
+def listo():
+    if not estado_arranque["listo"]:
+        return JSONResponse(status_code=503, content={"listo": False})
+    return {**estado_arranque}
 
 
 
@@ -72,10 +1193,9 @@ def registrar_rol(nuevo_rol: Rol):
         valo = "INSERT INTO roles (nombre, apellido, usuario, contrasena, documento, rol) VALUES (%s, %s, %s, %s, %s, %s)"
         valores = (nuevo_rol.nombre, nuevo_rol.apellido, nuevo_rol.usuario, nuevo_rol.contrasena, nuevo_rol.documento, nuevo_rol.rol)
 
-        cursor.execute(valo, valores)
-        mydb.commit()  # Guardar cambios antes de cerrar conexión
+        consulta("registrar_rol", cursor, valo, valores)
+        mydb.commit()  # Guardar cambios; la conexión vuelve al pool al terminar la petición
         cursor.close()
-        mydb.close()
 
         return {"informacion": "Rol registrado correctamente"}
 
@@ -115,20 +1235,21 @@ def registrar_bene(nuevo_bene: Beneficiario):
         mydb = get_db_connection()  # Abre una nueva conexión
         cursor = mydb.cursor(dictionary=True)  
         # Verificar si el beneficiario ya está registrado
-        cursor.execute("SELECT documento FROM beneficiarios WHERE documento = %s", (nuevo_bene.documento,))
-        if cursor.fetchone():
+        if consulta("beneficiario_existe", cursor, "SELECT documento FROM beneficiarios WHERE documento = %s", (nuevo_bene.documento,), obtener="uno"):
             cursor.close()
             raise HTTPException(status_code=400, detail="El beneficiario ya está registrado.")
 
         # Insertar el beneficiario en la base de datos
-        cursor.execute(
+        consulta(
+            "insertar_beneficiario", cursor,
             "INSERT INTO beneficiarios (nombre, apellido, documento, telefono, usuario, contrasena) VALUES (%s, %s, %s, %s, %s, %s)", 
             (nuevo_bene.nombre, nuevo_bene.apellido, nuevo_bene.documento, nuevo_bene.telefono, nuevo_bene.usuario, nuevo_bene.contrasena)
         )
 
         # Insertar los vehículos del beneficiario
         for vehiculo in nuevo_bene.vehiculos:
-            cursor.execute(
+            consulta(
+                "insertar_vehiculo", cursor,
                 "INSERT INTO vehiculos (placa, tipovehiculo, documento) VALUES (%s, %s, %s)", 
                 (vehiculo.placa, vehiculo.tipovehiculo, nuevo_bene.documento)
             )
@@ -171,18 +1292,16 @@ def obtener_qr(usuario: str):
         mydb = get_db_connection()
         cursor = mydb.cursor()
 
-        print(f"Buscando vehículos del usuario: {usuario}")  # DEPURACIÓN
-
         # Buscar al beneficiario y su vehículo
-        cursor.execute("""
+        resultado = consulta("qr_beneficiario", cursor, """
             SELECT b.nombre, b.apellido, b.documento, v.placa, v.tipovehiculo 
             FROM beneficiarios b
             JOIN vehiculos v ON b.documento = v.documento
             WHERE b.usuario = %s
-        """, (usuario,))
+            LIMIT 1
+        """, (usuario,), obtener="uno")
 
-        resultado = cursor.fetchone()
-        print(f"Resultado de la consulta: {resultado}")  # DEPURACIÓN
+        log_qr.debug("qr solicitado", extra={"datos": {"encontrado": bool(resultado)}})
 
         # Si no encuentra el usuario o vehículo, enviar error
         if not resultado:
@@ -198,11 +1317,16 @@ def obtener_qr(usuario: str):
             f"Tipo de vehiculo: {resultado[4]}"
         )
 
-        # Generar QR
+        # Generar QR (qrcode y PIL se importan solo cuando se necesitan)
+        import qrcode
+        inicio_qr = time.perf_counter()
         qr = qrcode.make(datos_qr)
         buffer = io.BytesIO()
         qr.save(buffer, format="PNG")
         img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+        duracion_qr = time.perf_counter() - inicio_qr
+        qr_render_segundos.observar(duracion_qr)
+        registrar_tiempo("qr", duracion_qr)
 
         cursor.close()
         return JSONResponse({"qr_code": img_base64})
@@ -240,9 +1364,8 @@ def login(LoginApli: LoginApp):
 # Creación de un cursor para ejecutar la consulta SQL
         mydb = get_db_connection()  # Abre una nueva conexión
         cursor = mydb.cursor(dictionary=True)  
-        cursor.execute("SELECT usuario FROM beneficiarios WHERE usuario = %s AND contrasena = %s",
-                    (LoginApli.usuario, LoginApli.contrasena))
-        usuario = cursor.fetchone()
+        usuario = consulta("login_app", cursor, "SELECT usuario FROM beneficiarios WHERE usuario = %s AND contrasena = %s",
+                    (LoginApli.usuario, LoginApli.contrasena), obtener="uno")
         cursor.close()
 
         if usuario:
@@ -284,19 +1407,18 @@ def verify_token_app(datos: TokenRequestapp):
 def mostrarempleados():
     try:
 # Creación de un cursor para ejecutar la consulta SQL
-        mydb = get_db_connection()  # Abre una nueva conexión
+        mydb = get_db_connection(lectura=True)  # Lectura: puede ir a una réplica
         cursor = mydb.cursor(dictionary=True)  
-        cursor.execute("SELECT id, nombre, apellido, documento, usuario, contrasena, rol FROM roles")
-        result = cursor.fetchall()
+        result = consulta("listar_empleados", cursor, "SELECT id, nombre, apellido, documento, usuario, contrasena, rol FROM roles", obtener="todos")
         cursor.close()
 
         if not result:
             return {"resultado": []}  # Si no hay resultados, devolver lista vacía
 
-        return {"resultado": jsonable_encoder(result)}  # Devuelve los resultados en formato JSON
+        return {"resultado": codificar(result)}  # Devuelve los resultados en formato JSON
 
     except Exception as error:
-        print(f"Error en la base de datos: {error}")  # Muestra el error real en la terminal
+        log_bd.error("error en la base de datos", extra={"datos": {"error": str(error)}})
         raise HTTPException(status_code=500, detail=f"Error en la base de datos: {error}")
 
 
@@ -311,22 +1433,21 @@ def mostrarempleados():
 def mostrarbeneficiarios():
     try:
 # Creación de un cursor para ejecutar la consulta SQL
-        mydb = get_db_connection()  # Abre una nueva conexión
+        mydb = get_db_connection(lectura=True)  # Lectura: puede ir a una réplica
         cursor = mydb.cursor(dictionary=True)  
-        cursor.execute("""
+        result = consulta("listar_beneficiarios", cursor, """
             SELECT 
                 b.id, b.nombre, b.apellido, b.documento, b.usuario, b.contrasena, 
                 v.placa, v.tipovehiculo 
             FROM beneficiarios b 
             LEFT JOIN vehiculos v ON b.documento = v.documento
-        """)
-        result = cursor.fetchall()
+        """, obtener="todos")
         cursor.close()
 
-        return {"resultado": jsonable_encoder(result)}  # Devuelve los resultados en formato JSON
+        return {"resultado": codificar(result)}  # Devuelve los resultados en formato JSON
 
     except Exception as error:
-        print(f"Error en la base de datos: {error}")  # Muestra el error en la terminal
+        log_bd.error("error en la base de datos", extra={"datos": {"error": str(error)}})
         raise HTTPException(status_code=500, detail=f"Error en la base de datos: {error}")
 
 
@@ -359,8 +1480,7 @@ def iniciar_sesion(datos: LoginRequest):
 
         mydb = get_db_connection()  # Conexión a la base de datos
         cursor = mydb.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM roles WHERE usuario = %s AND contrasena = %s", (usuario, contrasena))
-        usuario_encontrado = cursor.fetchone()
+        usuario_encontrado = consulta("login_empleado", cursor, "SELECT * FROM roles WHERE usuario = %s AND contrasena = %s", (usuario, contrasena), obtener="uno")
         cursor.close()
 
         if usuario_encontrado:
@@ -415,7 +1535,7 @@ def actualizarempleado(id:int,nuevorol: Rol):
 # Creación de un cursor para ejecutar la consulta SQL
         mydb = get_db_connection()  # Abre una nueva conexión
         cursor = mydb.cursor(dictionary=True)  
-        cursor.execute("""
+        consulta("actualizar_empleado", cursor, """
         UPDATE roles
         SET nombre = %s,
         apellido = %s,
@@ -445,8 +1565,7 @@ def buscarempleado(id: int):
 # Creación de un cursor para ejecutar la consulta SQL
         mydb = get_db_connection()  # Abre una nueva conexión
         cursor = mydb.cursor(dictionary=True)  
-        cursor.execute("SELECT * FROM roles WHERE id = %s", (id,))
-        empleado = cursor.fetchone()  # Obtener el primer resultado
+        empleado = consulta("buscar_empleado", cursor, "SELECT * FROM roles WHERE id = %s", (id,), obtener="uno")  # Obtener el primer resultado
         cursor.close()
 
         if empleado:
@@ -471,13 +1590,13 @@ def eliminarempleado(id: int):
         mydb = get_db_connection()  # Abre una nueva conexión
         cursor = mydb.cursor(dictionary=True)          
         # 1. Eliminar el empleado
-        cursor.execute("DELETE FROM roles WHERE id = %s", (id,))
+        consulta("eliminar_empleado", cursor, "DELETE FROM roles WHERE id = %s", (id,))
         mydb.commit()
 
         # 2. Reajustar los IDs secuenciales
-        cursor.execute("SET @count = 0")
-        cursor.execute("UPDATE roles SET id = @count:= @count + 1")
-        cursor.execute("ALTER TABLE roles AUTO_INCREMENT = 1")
+        consulta("reiniciar_contador_roles", cursor, "SET @count = 0")
+        consulta("renumerar_roles", cursor, "UPDATE roles SET id = @count:= @count + 1")
+        consulta("reiniciar_autoincremento_roles", cursor, "ALTER TABLE roles AUTO_INCREMENT = 1")
         mydb.commit()
 
         cursor.close()
@@ -507,18 +1626,40 @@ class BeneficiarioUpdate(BaseModel):
     documento: int
     usuario: str
     contrasena: str
-    vehiculos: Optional[List[VehiculoUpdate]] = []
+    # None deja los vehículos como están; una lista (aunque sea vacía) es el conjunto final
+    vehiculos: Optional[List[VehiculoUpdate]] = None
+
+
+def diferencia_vehiculos(actuales: dict, enviados: List[VehiculoUpdate]):
+    """
+    Compara los vehículos guardados ({placa: tipovehiculo}) con los enviados y
+    devuelve las placas a insertar, actualizar y eliminar.
+    """
+    nuevos = {v.placa: v.tipovehiculo for v in enviados}
+    agregar = [(placa, tipo) for placa, tipo in nuevos.items() if placa not in actuales]
+    actualizar = [(placa, tipo) for placa, tipo in nuevos.items() if placa in actuales and actuales[placa] != tipo]
+    eliminar = [placa for placa in actuales if placa not in nuevos]
+    return agregar, actualizar, eliminar
+
 
 @app.put("/actualizarbeneficiario/{id}")
 def actualizar_beneficiario(id: int, beneficiario: BeneficiarioUpdate):
+    mydb = None
+    cursor = None
     try:
         mydb = get_db_connection()  # Abre una nueva conexión
         cursor = mydb.cursor()
 
-        # 🔹 Verificar si el beneficiario existe
-        cursor.execute("SELECT COUNT(*) FROM beneficiarios WHERE id = %s", (id,))
-        if cursor.fetchone()[0] == 0:
+        # 🔹 Verificar si el beneficiario existe y obtener su documento actual
+        fila = consulta("documento_beneficiario", cursor, "SELECT documento FROM beneficiarios WHERE id = %s", (id,), obtener="uno")
+        if not fila:
             raise HTTPException(status_code=404, detail="Beneficiario no encontrado")
+        documento_anterior = fila[0]
+        documento = beneficiario.documento
+
+        # 🔹 El nuevo documento no puede pertenecer a otro beneficiario
+        if consulta("documento_en_uso", cursor, "SELECT id FROM beneficiarios WHERE documento = %s AND id <> %s", (documento, id), obtener="uno"):
+            raise HTTPException(status_code=400, detail="El documento ya está registrado para otro beneficiario.")
 
         # 🔹 Actualizar beneficiario
         query = """
@@ -526,31 +1667,56 @@ def actualizar_beneficiario(id: int, beneficiario: BeneficiarioUpdate):
             SET nombre = %s, apellido = %s, documento = %s, usuario = %s, contrasena = %s
             WHERE id = %s
         """
-        cursor.execute(query, (
-            beneficiario.nombre, beneficiario.apellido, beneficiario.documento, 
+        consulta("actualizar_beneficiario", cursor, query, (
+            beneficiario.nombre, beneficiario.apellido, documento, 
             beneficiario.usuario, beneficiario.contrasena, id
         ))
 
-        #Actualizar vehículos si existen
-        if beneficiario.vehiculos:
-            for vehiculo in beneficiario.vehiculos:
-                cursor.execute("""
-                    UPDATE vehiculos 
-                    SET placa = %s, tipovehiculo = %s
-                    WHERE documento = %s AND placa = %s
-                """, (vehiculo.placa, vehiculo.tipovehiculo, beneficiario.documento, vehiculo.placa))
-
-        #Confirmar cambios
+        # 🔹 Si cambió el documento, sus vehículos pasan al nuevo documento
+        # Se comparan como texto: la columna puede venir como int o como str según el driver
+        documento_cambiado = str(documento) != str(documento_anterior)
+        if documento_cambiado:
+            consulta("cambiar_documento_vehiculos", cursor,
+                     "UPDATE vehiculos SET documento = %s WHERE documento = %s", (documento, documento_anterior))
+
+        # 🔹 Sincronizar vehículos: se carga el conjunto actual una vez y solo se aplican las diferencias
+        agregar, actualizar, eliminar = [], [], []
+        if beneficiario.vehiculos is not None:
+            actuales = consulta("vehiculos_beneficiario", cursor,
+                                "SELECT placa, tipovehiculo FROM vehiculos WHERE documento = %s", (documento,), obtener="todos")
+            agregar, actualizar, eliminar = diferencia_vehiculos(dict(actuales), beneficiario.vehiculos)
+
+            consulta_lote("insertar_vehiculos", cursor,
+                          "INSERT INTO vehiculos (placa, tipovehiculo, documento) VALUES (%s, %s, %s)",
+                          [(placa, tipo, documento) for placa, tipo in agregar])
+            consulta_lote("actualizar_vehiculos", cursor,
+                          "UPDATE vehiculos SET tipovehiculo = %s WHERE documento = %s AND placa = %s",
+                          [(tipo, documento, placa) for placa, tipo in actualizar])
+            consulta_lote("eliminar_vehiculos", cursor,
+                          "DELETE FROM vehiculos WHERE documento = %s AND placa = %s",
+                          [(documento, placa) for placa in eliminar])
+
+        #Confirmar cambios (todo en una sola transacción)
         mydb.commit()
 
-        return {"mensaje": "Beneficiario y vehículos actualizados correctamente"}
+        return {
+            "mensaje": "Beneficiario y vehículos actualizados correctamente",
+            "cambios": {
+                "documento_anterior": documento_anterior if documento_cambiado else None,
+                "vehiculos_agregados": [placa for placa, _ in agregar],
+                "vehiculos_actualizados": [placa for placa, _ in actualizar],
+                "vehiculos_eliminados": eliminar,
+            }
+        }
 
     except mysql.connector.Error as error:
-        mydb.rollback()
+        if mydb:
+            mydb.rollback()
         raise HTTPException(status_code=500, detail=f"Error en la base de datos: {error}")
 
     finally:
-        cursor.close()
+        if cursor:
+            cursor.close()
         
         
         
@@ -563,24 +1729,22 @@ def buscar_beneficiario(id: int):
     try:
         mydb = get_db_connection()  # Abre una nueva conexión
         cursor = mydb.cursor(dictionary=True)
-        cursor.execute("""
+        beneficiario = consulta("buscar_beneficiario", cursor, """
             SELECT 
                 b.id, b.nombre, b.apellido, b.documento, b.usuario, b.contrasena, 
                 v.placa, v.tipovehiculo 
             FROM beneficiarios b
             LEFT JOIN vehiculos v ON b.documento = v.documento
             WHERE b.id = %s
-        """, (id,))
-        
-        beneficiario = cursor.fetchone()
+        """, (id,), obtener="uno")
         cursor.close()
 
-        print("Beneficiario encontrado:", beneficiario)  # <-- Agrega esta línea
+        log_bd.debug("beneficiario buscado", extra={"datos": {"id": id, "encontrado": bool(beneficiario)}})
 
         if not beneficiario:
             raise HTTPException(status_code=404, detail="Beneficiario no encontrado")
 
-        return {"resultado": jsonable_encoder(beneficiario)}
+        return {"resultado": codificar(beneficiario)}
 
     except Exception as error:
         raise HTTPException(status_code=500, detail=f"Error en la base de datos: {error}")
@@ -596,18 +1760,17 @@ def buscar_beneficiario(id: int):
 def mostraringresosalida():
     try:
 # Creación de un cursor para ejecutar la consulta SQL
-        mydb = get_db_connection()  # Abre una nueva conexión
+        mydb = get_db_connection(lectura=True)  # Lectura: puede ir a una réplica
         cursor = mydb.cursor(dictionary=True)  
-        cursor.execute("SELECT placa, documento, estado, fecha_ingreso, fecha_salida, puesto, valor_parqueo FROM registros")
-        result = cursor.fetchall()
+        result = consulta("listar_registros", cursor, "SELECT placa, documento, estado, fecha_ingreso, fecha_salida, puesto, valor_parqueo FROM registros", obtener="todos")
         cursor.close()
         
         if not result: 
             return{"resultado":[]}
-        return{"resultado": jsonable_encoder(result)}
+        return{"resultado": codificar(result)}
     
     except Exception as error:
-        print(f"Error en la base de datos: {error}")
+        log_bd.error("error en la base de datos", extra={"datos": {"error": str(error)}})
         raise HTTPException(status_code=500, detail="Error en la base de datos: {error}")
     
     
@@ -624,10 +1787,10 @@ def eliminar_beneficiario(id: int):
         mydb = get_db_connection()  # Abre una nueva conexión
         cursor = mydb.cursor(dictionary=True)  
         # 🔹 Eliminar vehículos relacionados con el beneficiario
-        cursor.execute("DELETE FROM vehiculos WHERE documento = (SELECT documento FROM beneficiarios WHERE id = %s)", (id,))
+        consulta("eliminar_vehiculos_beneficiario", cursor, "DELETE FROM vehiculos WHERE documento = (SELECT documento FROM beneficiarios WHERE id = %s)", (id,))
 
         # 🔹 Eliminar beneficiario
-        cursor.execute("DELETE FROM beneficiarios WHERE id = %s", (id,))
+        consulta("eliminar_beneficiario", cursor, "DELETE FROM beneficiarios WHERE id = %s", (id,))
         mydb.commit()
 
         cursor.close()
@@ -646,23 +1809,23 @@ def eliminar_beneficiario(id: int):
 
 @app.get("/puestos/")
 def obtener_puestos():
-
-# Creación de un cursor para ejecutar la consulta SQL
-    mydb = get_db_connection()  # Abre una nueva conexión
-    cursor = mydb.cursor(dictionary=True)  
     try:
-        # Obtener los puestos ocupados
+        # Creación de un cursor para ejecutar la consulta SQL
+        mydb = get_db_connection()  # Abre una nueva conexión
+        cursor = mydb.cursor(dictionary=True)
 
-        cursor.execute("SELECT puesto FROM registros WHERE estado = 'ingreso'")
-        ocupados = {row["puesto"] for row in cursor.fetchall()}
+        # Obtener los puestos ocupados
+        filas = consulta("puestos_ocupados", cursor, "SELECT puesto FROM registros WHERE estado = 'ingreso'", obtener="todos")
+        ocupados = {row["puesto"] for row in filas}
+        cursor.close()
 
         # Generar lista de puestos con su estado
         puestos = [{"id": i, "estado": "ocupado" if i in ocupados else "disponible"} for i in range(1, 21)]
 
         return {"puestos": puestos}
 
-    finally:
-        cursor.close()
+    except mysql.connector.Error as err:
+        raise HTTPException(status_code=500, detail=f"Error en la base de datos: {err}")
 
 
 
@@ -675,12 +1838,11 @@ def obtener_puestos():
 def ingreso_dia():
     try:
 # Creación de un cursor para ejecutar la consulta SQL
-        mydb = get_db_connection()  # Abre una nueva conexión
+        mydb = get_db_connection(lectura=True)  # Lectura: puede ir a una réplica
         cursor = mydb.cursor(dictionary=True)  
         fecha_hoy = datetime.now().strftime('%Y-%m-%d')
         
-        cursor.execute("SELECT COUNT(*) AS total FROM registros WHERE DATE(fecha_ingreso) = %s", (fecha_hoy,))
-        resultado = cursor.fetchone()
+        resultado = consulta("ingresos_dia", cursor, "SELECT COUNT(*) AS total FROM registros WHERE DATE(fecha_ingreso) = %s", (fecha_hoy,), obtener="uno")
 
         cursor.close()
 
@@ -697,12 +1859,11 @@ def ingreso_dia():
 def salida_dia():
     try:
 # Creación de un cursor para ejecutar la consulta SQL
-        mydb = get_db_connection()  # Abre una nueva conexión
+        mydb = get_db_connection(lectura=True)  # Lectura: puede ir a una réplica
         cursor = mydb.cursor(dictionary=True)  
         fecha_hoy = datetime.now().strftime('%Y-%m-%d')
         
-        cursor.execute("SELECT COUNT(*) AS total FROM registros WHERE fecha_salida IS NOT NULL AND DATE(fecha_salida) = %s", (fecha_hoy,))
-        resultado = cursor.fetchone()
+        resultado = consulta("salidas_dia", cursor, "SELECT COUNT(*) AS total FROM registros WHERE fecha_salida IS NOT NULL AND DATE(fecha_salida) = %s", (fecha_hoy,), obtener="uno")
         
         cursor.close()
         
@@ -720,10 +1881,9 @@ def salida_dia():
 def total_bene():
     try:
 # Creación de un cursor para ejecutar la consulta SQL
-        mydb = get_db_connection()  # Abre una nueva conexión
+        mydb = get_db_connection(lectura=True)  # Lectura: puede ir a una réplica
         cursor = mydb.cursor(dictionary=True)  
-        cursor.execute("SELECT COUNT(*) AS total FROM beneficiarios")
-        resultado = cursor.fetchone()
+        resultado = consulta("total_beneficiarios", cursor, "SELECT COUNT(*) AS total FROM beneficiarios", obtener="uno")
 
         cursor.close()
         return {"total_beneficiarios": resultado["total"]}
@@ -752,15 +1912,12 @@ def contactar(enviar: Contacto):
 
     try:
         mydb = get_db_connection()
-        if mydb is None:
-            return {"error": "No se pudo conectar a la base de datos"}
-
         cursor = mydb.cursor()
 
         comando = "INSERT INTO contactos (nombre, telefono, email, mensaje) VALUES (%s, %s, %s, %s)"
         valores = (enviar.nombre, enviar.telefono, enviar.email, enviar.mensaje)
 
-        cursor.execute(comando, valores)
+        consulta("insertar_contacto", cursor, comando, valores)
         mydb.commit()
 
         return {"mensaje": "Información enviada correctamente", "datos": valores}
@@ -776,8 +1933,6 @@ def contactar(enviar: Contacto):
     finally:
         if cursor:
             cursor.close()
-        if mydb:
-            mydb.close()
 
 
 
@@ -796,7 +1951,7 @@ class DatosGrafico(BaseModel):
 @app.get("/grafico", response_model=DatosGrafico)
 def grafico():
     try:
-        mydb = get_db_connection()
+        mydb = get_db_connection(lectura=True)
         cursor = mydb.cursor(dictionary=True)
         # Obtener la fecha de hoy y la fecha hace 7 días
 
@@ -807,24 +1962,24 @@ def grafico():
         salidas = [0] * 7
 
         # Consulta ingresos últimos 7 días
-        cursor.execute("""
+        filas = consulta("grafico_ingresos", cursor, """
             SELECT DAYOFWEEK(fecha_ingreso) AS dia, COUNT(*) AS cantidad
             FROM registros
             WHERE fecha_ingreso >= %s
             GROUP BY dia
-        """, (hace_7_dias,))
-        for row in cursor.fetchall():
+        """, (hace_7_dias,), obtener="todos")
+        for row in filas:
             dia = (row['dia'] + 5) % 7
             ingresos[dia] = row['cantidad']
 
         # Consulta salidas últimos 7 días
-        cursor.execute("""
+        filas = consulta("grafico_salidas", cursor, """
             SELECT DAYOFWEEK(fecha_salida) AS dia, COUNT(*) AS cantidad
             FROM registros
             WHERE fecha_salida IS NOT NULL AND fecha_salida >= %s
             GROUP BY dia
-        """, (hace_7_dias,))
-        for row in cursor.fetchall():
+        """, (hace_7_dias,), obtener="todos")
+        for row in filas:
             dia = (row['dia'] + 5) % 7
             salidas[dia] = row['cantidad']
 
@@ -836,4 +1991,10 @@ def grafico():
         }
 
     except Exception as error:
-        raise HTTPException(status_code=500, detail=f"Error en la base de datos: {error}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error en la base de datos: {error}")
+
+
+
+
+# Tiempo de importación del módulo (se compara con PRESUPUESTO_IMPORTACION al arrancar)
+TIEMPO_IMPORTACION = time.perf_counter() - INICIO_IMPORTACION
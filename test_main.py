@@ -0,0 +1,361 @@
+import asyncio
+import contextvars
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+class CursorFalso:
+    """Cursor en memoria para la tabla de beneficiarios y vehículos de un solo caso."""
+
+    def __init__(self, bd):
+        self.bd = bd
+        self.resultado = None
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.bd.sentencias.append((" ".join(sql.split()), params))
+        if sql.startswith("SELECT documento FROM beneficiarios"):
+            self.resultado = [(self.bd.documento,)] if params[0] == 1 else []
+        elif sql.startswith("SELECT id FROM beneficiarios"):
+            self.resultado = [(2,)] if params[0] in self.bd.otros_documentos else []
+        elif sql.startswith("SELECT placa, tipovehiculo FROM vehiculos"):
+            self.resultado = list(self.bd.vehiculos)
+        else:
+            self.resultado = []
+            self.rowcount = 1
+
+    def executemany(self, sql, filas):
+        self.bd.lotes.append((" ".join(sql.split()), filas))
+
+    def fetchone(self):
+        return self.resultado[0] if self.resultado else None
+
+    def fetchall(self):
+        return self.resultado
+
+    def close(self):
+        pass
+
+
+class ConexionFalsa:
+    def __init__(self, documento, vehiculos, otros_documentos=()):
+        self.documento = documento
+        self.vehiculos = vehiculos
+        self.otros_documentos = set(otros_documentos)
+        self.sentencias = []
+        self.lotes = []
+        self.confirmada = False
+
+    def cursor(self, **kwargs):
+        return CursorFalso(self)
+
+    def commit(self):
+        self.confirmada = True
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def cliente():
+    return TestClient(main.app)
+
+
+def usar_bd(monkeypatch, bd):
+    monkeypatch.setattr(main, "get_db_connection", lambda lectura=False: bd)
+    return bd
+
+
+def datos(documento=100, vehiculos=None):
+    cuerpo = {"nombre": "Ana", "apellido": "Gil", "documento": documento, "usuario": "ana", "contrasena": "x"}
+    if vehiculos is not None:
+        cuerpo["vehiculos"] = vehiculos
+    return cuerpo
+
+
+def lote(bd, inicio):
+    return next((filas for sql, filas in bd.lotes if sql.startswith(inicio)), None)
+
+
+def test_diferencia_vehiculos():
+    actuales = {"AAA111": "carro", "BBB222": "moto", "CCC333": "carro"}
+    enviados = [
+        main.VehiculoUpdate(placa="AAA111", tipovehiculo="carro"),
+        main.VehiculoUpdate(placa="BBB222", tipovehiculo="carro"),
+        main.VehiculoUpdate(placa="DDD444", tipovehiculo="moto"),
+    ]
+    agregar, actualizar, eliminar = main.diferencia_vehiculos(actuales, enviados)
+    assert agregar == [("DDD444", "moto")]
+    assert actualizar == [("BBB222", "carro")]
+    assert eliminar == ["CCC333"]
+
+
+def test_diferencia_vehiculos_lista_vacia_elimina_todo():
+    agregar, actualizar, eliminar = main.diferencia_vehiculos({"AAA111": "carro", "BBB222": "moto"}, [])
+    assert agregar == [] and actualizar == []
+    assert eliminar == ["AAA111", "BBB222"]
+
+
+def test_vehiculos_vacio_explicito_elimina_todos(monkeypatch, cliente):
+    bd = usar_bd(monkeypatch, ConexionFalsa(100, [("AAA111", "carro"), ("BBB222", "moto")]))
+    respuesta = cliente.put("/actualizarbeneficiario/1", json=datos(vehiculos=[]))
+    assert respuesta.status_code == 200
+    assert lote(bd, "DELETE FROM vehiculos") == [(100, "AAA111"), (100, "BBB222")]
+    assert respuesta.json()["cambios"]["vehiculos_eliminados"] == ["AAA111", "BBB222"]
+    assert bd.confirmada
+
+
+def test_vehiculos_omitidos_no_se_tocan(monkeypatch, cliente):
+    bd = usar_bd(monkeypatch, ConexionFalsa(100, [("AAA111", "carro")]))
+    respuesta = cliente.put("/actualizarbeneficiario/1", json=datos())
+    assert respuesta.status_code == 200
+    assert bd.lotes == []
+    assert not any("vehiculos" in sql for sql, _ in bd.sentencias)
+
+
+def test_documento_de_otro_beneficiario_se_rechaza(monkeypatch, cliente):
+    bd = usar_bd(monkeypatch, ConexionFalsa(100, [("AAA111", "carro")], otros_documentos=[200]))
+    respuesta = cliente.put("/actualizarbeneficiario/1", json=datos(documento=200, vehiculos=[]))
+    assert respuesta.status_code == 400
+    assert not any(sql.startswith(("UPDATE", "DELETE")) for sql, _ in bd.sentencias)
+    assert bd.lotes == [] and not bd.confirmada
+
+
+def test_documento_como_texto_no_dispara_cascada(monkeypatch, cliente):
+    bd = usar_bd(monkeypatch, ConexionFalsa("100", [("AAA111", "carro")]))
+    respuesta = cliente.put("/actualizarbeneficiario/1", json=datos(documento=100, vehiculos=[{"placa": "AAA111", "tipovehiculo": "carro"}]))
+    assert respuesta.status_code == 200
+    assert respuesta.json()["cambios"]["documento_anterior"] is None
+    assert not any(sql.startswith("UPDATE vehiculos SET documento") for sql, _ in bd.sentencias)
+
+
+def test_documento_cambiado_pasa_los_vehiculos(monkeypatch, cliente):
+    bd = usar_bd(monkeypatch, ConexionFalsa(100, []))
+    respuesta = cliente.put("/actualizarbeneficiario/1", json=datos(documento=300))
+    assert respuesta.status_code == 200
+    assert ("UPDATE vehiculos SET documento = %s WHERE documento = %s", (300, 100)) in bd.sentencias
+    assert respuesta.json()["cambios"]["documento_anterior"] == 100
+
+
+class PoolRoto:
+    def get_connection(self):
+        raise main.mysql.connector.errors.InternalError(msg="Unread result found")
+
+
+class ConexionPoolFalsa:
+    """Conexión del pool cuyo close() falla como cuando quedó un resultado sin leer."""
+
+    def __init__(self):
+        self._cnx = ConexionFalsa(100, [])
+        self._cnx.cerrada = False
+        self._cnx.close = lambda: setattr(self._cnx, "cerrada", True)
+
+    def close(self):
+        raise main.mysql.connector.errors.InternalError(msg="Unread result found")
+
+
+def test_conexion_invalida_del_pool_abre_una_directa(monkeypatch):
+    destino = main.DestinoBD("prueba", {})
+    destino.pool = PoolRoto()
+    directa = ConexionFalsa(100, [])
+    monkeypatch.setattr(main.mysql.connector, "connect", lambda **config: directa)
+    assert main.conectar(destino) is directa
+    assert destino.circuito.fallos == 0
+
+
+def test_cerrar_conexion_que_falla_cierra_la_conexion_real():
+    conexion = ConexionPoolFalsa()
+    main.cerrar_conexiones([(main.bd_primaria, conexion)])
+    assert conexion._cnx.cerrada
+
+
+def circuito_abierto(tiempo_abierto=60.0):
+    circuito = main.CircuitoBD(max_fallos=2, tiempo_abierto=tiempo_abierto)
+    circuito.registrar_fallo()
+    circuito.registrar_fallo()
+    return circuito
+
+
+def en_contexto(funcion, *args):
+    # Cada petición corre en su propio contexto (sonda_circuito es un contextvar)
+    return contextvars.copy_context().run(funcion, *args)
+
+
+def test_circuito_se_abre_tras_max_fallos():
+    circuito = main.CircuitoBD(max_fallos=2, tiempo_abierto=60.0)
+    circuito.registrar_fallo()
+    assert not circuito.esta_abierto() and circuito.permitir()
+    circuito.registrar_fallo()
+    assert circuito.esta_abierto() and not circuito.permitir()
+    assert circuito.segundos_restantes() > 0
+
+
+def test_circuito_semiabierto_deja_pasar_una_sola_prueba():
+    circuito = circuito_abierto(tiempo_abierto=0.0)
+
+    def peticion():
+        if not circuito.reservar_prueba():
+            return None
+        return circuito.permitir()
+
+    assert en_contexto(peticion) is True
+    # Mientras la prueba no termina el circuito sigue abierto para los demás
+    assert circuito.esta_abierto()
+    assert en_contexto(peticion) is None
+    assert not en_contexto(circuito.permitir)
+
+
+def test_circuito_prueba_exitosa_cierra_y_fallida_reabre():
+    circuito = circuito_abierto(tiempo_abierto=0.0)
+    assert en_contexto(circuito.reservar_prueba)
+    circuito.registrar_fallo()
+    assert circuito.esta_abierto() and not circuito.probando
+    assert en_contexto(circuito.reservar_prueba)
+    circuito.registrar_exito()
+    assert not circuito.esta_abierto() and circuito.permitir()
+
+
+def test_circuito_prueba_liberada_sin_conectar_deja_probar_a_otro():
+    circuito = circuito_abierto(tiempo_abierto=0.0)
+    assert en_contexto(circuito.reservar_prueba)
+    assert not en_contexto(circuito.reservar_prueba)
+    circuito.liberar_prueba()
+    assert en_contexto(circuito.reservar_prueba)
+
+
+def test_limite_ruta_descarta_sin_cola():
+    async def caso():
+        limite = main.LimiteRuta(concurrencia=1, cola=0, espera=1.0)
+        assert await limite.entrar()
+        inicio = time.perf_counter()
+        assert not await limite.entrar()
+        assert time.perf_counter() - inicio < 0.1  # Se descarta al instante
+        limite.salir()
+        assert await limite.entrar()
+
+    asyncio.run(caso())
+
+
+def test_limite_ruta_descarta_tras_la_espera():
+    async def caso():
+        limite = main.LimiteRuta(concurrencia=1, cola=1, espera=0.05)
+        assert await limite.entrar()
+        assert not await limite.entrar()
+        assert limite.esperando == 0
+
+    asyncio.run(caso())
+
+
+def test_limite_ruta_la_cola_entra_al_liberarse():
+    async def caso():
+        limite = main.LimiteRuta(concurrencia=1, cola=1, espera=1.0)
+        assert await limite.entrar()
+        en_cola = asyncio.ensure_future(limite.entrar())
+        await asyncio.sleep(0)
+        limite.salir()
+        assert await en_cola
+
+    asyncio.run(caso())
+
+
+@pytest.fixture
+def ruta_con_error_bd():
+    def endpoint():
+        raise main.BDNoDisponible(msg="Base de datos no disponible")
+
+    main.app.add_api_route("/prueba_error_bd", endpoint)
+    yield "/prueba_error_bd"
+    main.app.router.routes[:] = [r for r in main.app.router.routes if getattr(r, "path", None) != "/prueba_error_bd"]
+
+
+def test_error_de_bd_sin_atrapar_responde_503(cliente, ruta_con_error_bd):
+    respuesta = cliente.get(ruta_con_error_bd)
+    assert respuesta.status_code == 503
+    assert respuesta.headers["Retry-After"] == "1"
+
+
+def test_puestos_con_la_bd_caida_no_corta_la_conexion(monkeypatch, cliente):
+    def caida(lectura=False):
+        raise main.mysql.connector.errors.InterfaceError(msg="Can't connect to MySQL server")
+
+    monkeypatch.setattr(main, "get_db_connection", caida)
+    respuesta = cliente.get("/puestos/")
+    assert respuesta.status_code == 500
+    assert "Error en la base de datos" in respuesta.json()["detail"]
+
+
+def test_peticion_rechazada_se_mide_con_la_plantilla(monkeypatch, cliente):
+    monkeypatch.setattr(main.circuito_bd, "fallos", main.circuito_bd.max_fallos)
+    monkeypatch.setattr(main.circuito_bd, "abierto_hasta", time.monotonic() + 60)
+    respuesta = cliente.get("/obtener_qr/ana")
+    assert respuesta.status_code == 503
+    assert ("/obtener_qr/{usuario}", "GET", "503") in main.peticiones_segundos.valores()
+    assert not any("ana" in clave[0] for clave in main.peticiones_segundos.valores())
+
+
+def test_volcados_ignoran_archivos_que_no_son_de_un_worker():
+    assert main.pid_volcado("1234.json") == 1234
+    assert main.pid_volcado("notas.json") is None
+    assert main.pid_volcado("1234.json.tmp") is None
+
+
+def test_log_de_peticion_rechazada_lleva_la_plantilla(monkeypatch, cliente):
+    rutas = []
+    monkeypatch.setattr(main.log_http, "info", lambda *args, **kwargs: rutas.append(main.ruta_peticion.get()))
+    monkeypatch.setattr(main.circuito_bd, "fallos", main.circuito_bd.max_fallos)
+    monkeypatch.setattr(main.circuito_bd, "abierto_hasta", time.monotonic() + 60)
+    assert cliente.get("/obtener_qr/ana").status_code == 503
+    assert rutas == ["/obtener_qr/{usuario}"]
+
+
+class CursorListado(CursorFalso):
+    def execute(self, sql, params=None):
+        self.resultado = list(self.bd.filas)
+
+
+class ConexionListado(ConexionFalsa):
+    def __init__(self, filas):
+        super().__init__(100, [])
+        self.filas = filas
+
+    def cursor(self, **kwargs):
+        return CursorListado(self)
+
+
+def server_timing(respuesta) -> dict:
+    tiempos = {}
+    for parte in respuesta.headers["Server-Timing"].split(", "):
+        nombre, _, duracion = parte.partition(";dur=")
+        assert nombre not in tiempos
+        tiempos[nombre] = float(duracion)
+    return tiempos
+
+
+def test_server_timing_separa_la_serializacion_del_listado(monkeypatch, cliente):
+    filas = [{"id": i, "nombre": "Ana", "apellido": "Gil", "documento": i, "telefono": 300, "usuario": f"u{i}"} for i in range(20000)]
+    usar_bd(monkeypatch, ConexionListado(filas))
+    respuesta = cliente.get("/mostrarbeneficiarios")
+    assert respuesta.status_code == 200
+    tiempos = server_timing(respuesta)
+    assert 0 < tiempos["serializacion"] <= tiempos["total"]
+
+
+def test_server_timing_de_grafico_incluye_serializacion(monkeypatch, cliente):
+    usar_bd(monkeypatch, ConexionListado([{"dia": 2, "cantidad": 3}]))
+    respuesta = cliente.get("/grafico")
+    assert respuesta.status_code == 200
+    assert "serializacion" in server_timing(respuesta)
+
+
+def test_cors_expone_la_cabecera_de_escritura(cliente):
+    respuesta = cliente.get("/listo", headers={"Origin": "https://otro.ejemplo"})
+    expuestas = respuesta.headers["Access-Control-Expose-Headers"]
+    for cabecera in ("X-Ultima-Escritura", "X-Request-ID", "Server-Timing"):
+        assert cabecera in expuestas